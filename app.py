@@ -2,23 +2,36 @@ import streamlit as st
 from PIL import Image
 import math
 from collections import Counter
-from utils import similarity_search_via_image, create_search_index_in_azure_ai_search
+from utils import similarity_search_via_image, ensure_search_index
 from azure_blob_storage import create_container_if_not_exists, parse_blob_url, list_blob_sas_urls_from_folder
 from gpt_gen import generate_top_n_search_results
 from authentication import login, logout
 from helpers import clickable_image, handle_action, header_html
 from image_data import images, mapped_data
+from primary_images import get_primary_image_index
 from vars import BLOB_CONNECTION_STRING, CONTAINER_NAME
 
 # Extract the storage account name from the connection string
 storage_account_name = BLOB_CONNECTION_STRING.split(";")[1].split("=")[1]
-create_search_index_in_azure_ai_search()
-container_client = create_container_if_not_exists(
-    connection_string= BLOB_CONNECTION_STRING, container_name = CONTAINER_NAME)
+
+
+@st.cache_resource(show_spinner=False)
+def provision_resources():
+    # Runs once per process instead of on every rerun
+    ensure_search_index()
+    container_client = create_container_if_not_exists(
+        connection_string= BLOB_CONNECTION_STRING, container_name = CONTAINER_NAME)
+
+    # One bulk listing when no primary image index was shipped or built at ingest time
+    primary_image_index = get_primary_image_index()
+    if primary_image_index.is_empty(CONTAINER_NAME):
+        primary_image_index.rebuild(BLOB_CONNECTION_STRING, CONTAINER_NAME)
+    return container_client
 
 
 # Streamlit app
 st.set_page_config(layout="wide") # st.set_page_config(layout="centered")
+container_client = provision_resources()
 st.write('')
 st.markdown(header_html, unsafe_allow_html=True)
 
@@ -29,12 +42,6 @@ if 'login_status' not in st.session_state:
 if st.session_state['login_status']:
 
     st.title('Find Variants')
-    with st.spinner("Wait....Checking/loading all the resources.."):
-        if not container_client.exists():
-            # If the container doesn't exist, create it
-            container_client.create_container()
-            print(f"Container {CONTAINER_NAME}")
-
 
     if 'selected_image_path' not in st.session_state:
         st.session_state.selected_image_path = None
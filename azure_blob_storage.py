@@ -1,17 +1,64 @@
 from azure.core.exceptions import ResourceExistsError
-from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions, ContainerClient, ContentSettings
+from azure.storage.blob import BlobServiceClient, generate_blob_sas, BlobSasPermissions, ContentSettings
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import requests
 import io
-from urllib.parse import urlparse
+import threading
+from urllib.parse import urlparse, quote
 import re
+from thumbnails import parse_thumbnail_blob_name, upload_thumbnails
 from vars import BLOB_CONNECTION_STRING, CONTAINER_NAME
 # Azure Blob Storage configuration
 
 
 image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff')
 
+SAS_TOKEN_LIFETIME = timedelta(hours=1)
+# Cached SAS URLs are re-signed once they are this close to expiring
+SAS_REFRESH_MARGIN = timedelta(minutes=5)
+MAX_CACHED_SAS_URLS = 10000
+
+_blob_service_clients = {}
+_container_clients = {}
+_clients_lock = threading.Lock()
+
+_sas_url_cache = {}
+_sas_url_cache_lock = threading.Lock()
+
+
+def get_blob_service_client(connection_string: str):
+    """
+    Returns the shared BlobServiceClient for a connection string, so its
+    connection pool is reused across calls.
+
+    :param connection_string: The connection string to the Azure Storage Account.
+    :return: The BlobServiceClient object.
+    """
+    with _clients_lock:
+        blob_service_client = _blob_service_clients.get(connection_string)
+        if blob_service_client is None:
+            blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+            _blob_service_clients[connection_string] = blob_service_client
+    return blob_service_client
+
+
+def get_container_client(connection_string: str, container_name: str):
+    """
+    Returns the shared ContainerClient for a connection string and container.
+
+    :param connection_string: The connection string to the Azure Storage Account.
+    :param container_name: The name of the Azure Blob Storage container.
+    :return: The ContainerClient object.
+    """
+    blob_service_client = get_blob_service_client(connection_string)
+    with _clients_lock:
+        container_client = _container_clients.get((connection_string, container_name))
+        if container_client is None:
+            container_client = blob_service_client.get_container_client(container_name)
+            _container_clients[(connection_string, container_name)] = container_client
+    return container_client
+
 
 def sanitize_blob_name(blob_name):
     """
@@ -30,12 +77,8 @@ def create_container_if_not_exists(connection_string: str, container_name: str):
     :param container_name: The name of the container to create.
     :return: The ContainerClient object.
     """
-    # Create a BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string)
-
-    # Get a ContainerClient
-    container_client = blob_service_client.get_container_client(container_name)
+    # Get the shared ContainerClient
+    container_client = get_container_client(connection_string, container_name)
 
     try:
         # Create the container if it does not exist
@@ -53,18 +96,17 @@ def create_container_if_not_exists(connection_string: str, container_name: str):
 def upload_files_to_blob_subfolder(connection_string: str, container_name: str, folder_path: str, file_path: str, custom_folder: str):
     """
     Uploads all files from a local folder to a specified subfolder in an Azure Blob Storage container.
+    Images also get resized thumbnails under the thumbnail prefix.
 
     :param connection_string: The connection string to the Azure Storage Account.
     :param container_name: The name of the Azure Blob Storage container.
     :param folder_path: The local folder path containing the files to upload.
     :param custom_folder: The subfolder name in the blob container.
+    :return: A dict mapping each uploaded blob name to the widths of the
+        thumbnails uploaded for it; empty for other files and failed renders.
     """
-    # Create a BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string)
-
-    # Get a ContainerClient
-    container_client = blob_service_client.get_container_client(container_name)
+    # Get the shared ContainerClient
+    container_client = get_container_client(connection_string, container_name)
 
     # List all files in the folder
     if folder_path != '':
@@ -72,7 +114,7 @@ def upload_files_to_blob_subfolder(connection_string: str, container_name: str,
     else:
         file_names = [file_path]
 
-    uploaded_filenames = []
+    uploaded_filenames = {}
 
     for file_name in file_names:
         timestamp = str(datetime.now().timestamp()).replace('.', '')
@@ -86,15 +128,24 @@ def upload_files_to_blob_subfolder(connection_string: str, container_name: str,
         blob_name = os.path.join(custom_folder, file_name_with_timestamp)
         blob_name = sanitize_blob_name(blob_name)
 
-        blob_client = blob_service_client.get_blob_client(
-            container=container_name, blob=blob_name)
+        blob_client = container_client.get_blob_client(blob_name)
+
+        with open(file_full_path, mode="rb") as f:
+            data = f.read()
+        blob_client.upload_blob(data, overwrite=True)
 
-        with open(file_full_path, mode="rb") as data:
-            blob_client.upload_blob(data, overwrite=True)
+        thumbnail_widths = []
+        if blob_name.lower().endswith(image_extensions):
+            # Images without thumbnails are displayed from the original blob
+            try:
+                thumbnail_widths = [parse_thumbnail_blob_name(name)[1]
+                                    for name in upload_thumbnails(container_client, blob_name, data)]
+            except Exception as e:
+                print(f"Could not create thumbnails of {blob_name}: {e}")
 
         # print(f"Uploaded {file_name_with_timestamp} to '{custom_folder}' in container {container_name}.")
 
-        uploaded_filenames.append(blob_name)
+        uploaded_filenames[blob_name] = thumbnail_widths
 
     return uploaded_filenames
 
@@ -108,12 +159,8 @@ def upload_files_from_urls_to_blob_subfolder(connection_string: str, container_n
     :param file_urls: List of URLs of the files to upload.
     :param custom_folder: The subfolder name in the blob container.
     """
-    # Create a BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string)
-
-    # Get a ContainerClient
-    container_client = blob_service_client.get_container_client(container_name)
+    # Get the shared ContainerClient
+    container_client = get_container_client(connection_string, container_name)
 
     filenames = []
 
@@ -127,8 +174,7 @@ def upload_files_from_urls_to_blob_subfolder(connection_string: str, container_n
         blob_name = os.path.join(custom_folder, file_name)
         blob_name = sanitize_blob_name(blob_name)
 
-        blob_client = blob_service_client.get_blob_client(
-            container=container_name, blob=blob_name)
+        blob_client = container_client.get_blob_client(blob_name)
 
         # Download the file from the URL
         response = requests.get(file_url)
@@ -152,13 +198,8 @@ def delete_blob(connection_string: str, container_name: str, blob_name: str):
     :param container_name: The name of the Azure Blob Storage container.
     :param blob_name: The name of the blob to delete.
     """
-    # Create a BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string)
-
     # Get a BlobClient for the specified blob
-    blob_client = blob_service_client.get_blob_client(
-        container=container_name, blob=blob_name)
+    blob_client = get_container_client(connection_string, container_name).get_blob_client(blob_name)
 
     # Delete the blob
     blob_client.delete_blob()
@@ -172,20 +213,15 @@ def delete_all_blobs_in_container(connection_string: str, container_name: str):
     :param connection_string: The connection string to the Azure Storage Account.
     :param container_name: The name of the Azure Blob Storage container.
     """
-    # Create a BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string)
-
-    # Get a ContainerClient for the specified container
-    container_client = blob_service_client.get_container_client(container_name)
+    # Get the shared ContainerClient for the specified container
+    container_client = get_container_client(connection_string, container_name)
 
     # List and delete all blobs in the container
     blob_list = container_client.list_blobs()
 
     for blob in blob_list:
         # print(f"Deleting blob: {blob.name}")
-        blob_client = blob_service_client.get_blob_client(
-            container=container_name, blob=blob.name)
+        blob_client = container_client.get_blob_client(blob.name)
         blob_client.delete_blob()
         # print(f"Deleted blob '{blob.name}' from container '{container_name}'.")
 
@@ -199,8 +235,7 @@ def delete_all_blobs_from_folder(connection_string: str, container_name: str, fo
     :param folder_name: The name of the folder to delete blobs from.
     """
 
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container_name)
+    container_client = get_container_client(connection_string, container_name)
 
     # List all blobs in the specified folder
     blobs = container_client.list_blobs(name_starts_with=folder_name)
@@ -212,9 +247,8 @@ def delete_all_blobs_from_folder(connection_string: str, container_name: str, fo
 
 
 def get_folders_with_substring(connection_string, container_name, substring):
-    # Initialize the BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-    container_client = blob_service_client.get_container_client(container_name)
+    # Get the shared ContainerClient
+    container_client = get_container_client(connection_string, container_name)
 
     # List all blobs in the container
     blob_list = container_client.list_blobs()
@@ -243,14 +277,9 @@ def get_blob_url(connection_string: str, container_name: str, blob_name: str):
     :param blob_name: The name of the blob to get the URL for.
     :return: The URL of the blob.
     """
-
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string)
-    blob_client = blob_service_client.get_blob_client(
-        container=container_name, blob=blob_name)
-
-    # Get the blob URL
-    blob_url = blob_client.url
+    # Built locally, the same way BlobClient.url encodes the blob name
+    container_client = get_container_client(connection_string, container_name)
+    blob_url = f"{container_client.url.rstrip('/')}/{quote(blob_name, safe='~/')}"
     # print(f"Blob URL: {blob_url}")
     return blob_url
 
@@ -264,10 +293,16 @@ def generate_sas_token(connection_string: str, container_name: str, blob_name: s
     :param blob_name: The name of the blob to generate the SAS token for.
     :return: The SAS URL of the blob.
     """
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string)
-    blob_client = blob_service_client.get_blob_client(
-        container=container_name, blob=blob_name)
+    # SAS signing is a local HMAC, so a cached URL is reused until shortly before it expires
+    cache_key = (connection_string, container_name, blob_name)
+    now = datetime.now(timezone.utc)
+    with _sas_url_cache_lock:
+        cached = _sas_url_cache.get(cache_key)
+    if cached is not None and cached[1] - SAS_REFRESH_MARGIN > now:
+        return cached[0]
+
+    blob_service_client = get_blob_service_client(connection_string)
+    expiry = now + SAS_TOKEN_LIFETIME  # Token valid for 1 hour
 
     sas_token = generate_blob_sas(
         account_name=blob_service_client.account_name,
@@ -275,10 +310,19 @@ def generate_sas_token(connection_string: str, container_name: str, blob_name: s
         blob_name=blob_name,
         account_key=blob_service_client.credential.account_key,
         permission=BlobSasPermissions(read=True),
-        expiry=datetime.now() + timedelta(hours=1)  # Token valid for 1 hour
+        expiry=expiry
     )
 
-    sas_url = f"{blob_client.url}?{sas_token}"
+    sas_url = f"{get_blob_url(connection_string, container_name, blob_name)}?{sas_token}"
+
+    with _sas_url_cache_lock:
+        if len(_sas_url_cache) >= MAX_CACHED_SAS_URLS:
+            for key in [key for key, (_, key_expiry) in _sas_url_cache.items()
+                        if key_expiry - SAS_REFRESH_MARGIN <= now]:
+                del _sas_url_cache[key]
+            if len(_sas_url_cache) >= MAX_CACHED_SAS_URLS:
+                _sas_url_cache.clear()
+        _sas_url_cache[cache_key] = (sas_url, expiry)
     return sas_url
 
 
@@ -307,9 +351,7 @@ def list_blob_urls_from_folder(connection_string: str, container_name: str, fold
     :return: A list of blob URLs.
     """
 
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string)
-    container_client = blob_service_client.get_container_client(container_name)
+    container_client = get_container_client(connection_string, container_name)
 
     # List all blobs in the specified folder
     blob_urls = []
@@ -331,9 +373,7 @@ def list_blob_sas_urls_from_folder(connection_string: str, container_name: str,
     :param folder_name: The name of the folder to list blobs from.
     :return: A list of blob SAS URLs.
     """
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string)
-    container_client = blob_service_client.get_container_client(container_name)
+    container_client = get_container_client(connection_string, container_name)
 
     sas_urls = []
     blobs = container_client.list_blobs(name_starts_with=folder_name)
@@ -355,12 +395,8 @@ def list_child_folders(connection_string: str, container_name: str, parent_folde
     :param parent_folder: The parent folder to list child folders from. Default is the root of the container.
     :return: A list of unique child folder names.
     """
-    # Create a BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(
-        connection_string)
-
-    # Get a ContainerClient
-    container_client = blob_service_client.get_container_client(container_name)
+    # Get the shared ContainerClient
+    container_client = get_container_client(connection_string, container_name)
 
     # List all blobs with the specified parent folder prefix
     blob_list = container_client.list_blobs(name_starts_with=parent_folder)
@@ -403,8 +439,7 @@ def download_blob(image_filename, connection_string, container_name):
     :return: The image file as a binary stream.
     """
 
-    container_client = ContainerClient.from_connection_string(
-        connection_string, container_name)
+    container_client = get_container_client(connection_string, container_name)
     blob_client = container_client.get_blob_client(image_filename)
     blob_image = blob_client.download_blob().readall()
 
@@ -414,9 +449,15 @@ def download_blob(image_filename, connection_string, container_name):
 
 
 def upload_image_to_blob(image, folder_name):
-    # Initialize the BlobServiceClient
-    blob_service_client = BlobServiceClient.from_connection_string(BLOB_CONNECTION_STRING)
-    container_client = blob_service_client.get_container_client(CONTAINER_NAME)
+    """
+    Uploads an image uploaded through Streamlit, together with its thumbnails.
+
+    :param image: The UploadedFile to upload.
+    :param folder_name: The folder to upload the image to.
+    :return: A status message.
+    """
+    # Get the shared ContainerClient
+    container_client = get_container_client(BLOB_CONNECTION_STRING, CONTAINER_NAME)
     try:
         # Create a unique blob name with the folder and image name
         blob_name = f"{folder_name}/{image.name}"
@@ -425,9 +466,16 @@ def upload_image_to_blob(image, folder_name):
         blob_client = container_client.get_blob_client(blob_name)
 
         # Upload the image
+        data = image.getvalue()
         blob_client.upload_blob(
-            image, content_settings=ContentSettings(content_type=image.type))
-
-        return f"Uploaded {image.name} to {blob_name}"
+            data, content_settings=ContentSettings(content_type=image.type))
     except Exception as e:
         return f"Failed to upload {image.name}. Error: {e}"
+
+    # The primary image index lists the folder's blobs, so a missing thumbnail is never referenced
+    try:
+        upload_thumbnails(container_client, blob_name, data)
+    except Exception as e:
+        print(f"Could not create thumbnails of {blob_name}: {e}")
+
+    return f"Uploaded {image.name} to {blob_name}"
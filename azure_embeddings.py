@@ -1,6 +1,205 @@
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import requests
+from requests.adapters import HTTPAdapter
+from embedding_cache import get_embedding_cache
 from gpt_gen import generate_item_description
-from vars import VISION_ENDPOINT, VISION_SUBSCRIPTION_KEY, VISION_VERSION
+from image_preprocess import preprocess_for_vision
+from vars import VISION_ENDPOINT, VISION_SUBSCRIPTION_KEY, VISION_VERSION, VISION_MODEL_VERSION, \
+    VISION_CONNECT_TIMEOUT, VISION_READ_TIMEOUT, VISION_MAX_RETRIES, VISION_BACKOFF_FACTOR, VISION_POOL_SIZE, \
+    VISION_IMAGE_MAX_SIDE
+
+
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+MAX_RETRY_AFTER_SECONDS = 60
+
+
+class EmbeddingError(Exception):
+    """
+    Base class for errors raised while generating an embedding.
+    """
+
+
+class EmbeddingTimeoutError(EmbeddingError):
+    """
+    Raised when the Vision API does not answer within the configured timeouts.
+    """
+
+
+class EmbeddingConnectionError(EmbeddingError):
+    """
+    Raised when the Vision API cannot be reached.
+    """
+
+
+class EmbeddingHTTPError(EmbeddingError):
+    """
+    Raised when the Vision API answers with a non-success status code.
+    """
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _retry_after_seconds(response):
+    """
+    Parses the Retry-After header of a response, in seconds, or returns None.
+    """
+    retry_after = response.headers.get("Retry-After")
+    if not retry_after:
+        return None
+
+    try:
+        seconds = float(retry_after)
+    except ValueError:
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            return None
+        seconds = (retry_at - datetime.now(timezone.utc)).total_seconds()
+
+    return min(max(seconds, 0.0), MAX_RETRY_AFTER_SECONDS)
+
+
+class EmbeddingClient:
+    """
+    Client for the Azure AI Vision 4.0 retrieval APIs that keeps connections
+    alive between calls, bounds every request with connect/read timeouts and
+    retries throttled or failed requests with exponential backoff.
+    """
+
+    def __init__(
+        self,
+        endpoint: str,
+        key: str,
+        version: str,
+        connect_timeout: float = VISION_CONNECT_TIMEOUT,
+        read_timeout: float = VISION_READ_TIMEOUT,
+        max_retries: int = VISION_MAX_RETRIES,
+        backoff_factor: float = VISION_BACKOFF_FACTOR,
+        pool_size: int = VISION_POOL_SIZE,
+    ):
+        """
+        :param endpoint: The endpoint of the Azure AI Vision resource.
+        :param key: The access key of the Azure AI Vision resource.
+        :param version: The version of the API.
+        :param connect_timeout: Seconds to wait for a connection to be established.
+        :param read_timeout: Seconds to wait for the response.
+        :param max_retries: How many times a failed request is retried.
+        :param backoff_factor: Base delay, in seconds, of the exponential backoff.
+        :param pool_size: The number of keep-alive connections kept open.
+        """
+        self.endpoint = endpoint
+        self.version = version
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Ocp-Apim-Subscription-Key"] = key
+
+    def _url(self, operation: str):
+        return (f"{self.endpoint}retrieval:{operation}"
+                f"?api-version={self.version}&modelVersion={VISION_MODEL_VERSION}")
+
+    def _backoff_seconds(self, attempt: int):
+        return self.backoff_factor * (2 ** attempt) * (1 + random.random() / 2)
+
+    def _post(self, operation: str, description: str, **kwargs):
+        """
+        Posts a vectorize request, retrying on timeouts, connection errors
+        and retryable status codes.
+
+        :return: A tuple of (embedding, the model version that produced it).
+        """
+        url = self._url(operation)
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                r = self.session.post(url, timeout=self.timeout, **kwargs)
+            except requests.Timeout as e:
+                if last_attempt:
+                    raise EmbeddingTimeoutError(
+                        f"Timed out while processing {description}: {e}") from e
+                time.sleep(self._backoff_seconds(attempt))
+                continue
+            except requests.ConnectionError as e:
+                if last_attempt:
+                    raise EmbeddingConnectionError(
+                        f"Could not connect while processing {description}: {e}") from e
+                time.sleep(self._backoff_seconds(attempt))
+                continue
+
+            if r.status_code == 200:
+                content = r.json()
+                return content["vector"], content.get("modelVersion") or VISION_MODEL_VERSION
+
+            if r.status_code not in RETRYABLE_STATUS_CODES or last_attempt:
+                raise EmbeddingHTTPError(
+                    f"An error occurred while processing {description}. "
+                    f"Error code: {r.status_code}.", r.status_code)
+
+            retry_after = _retry_after_seconds(r) if r.status_code in (429, 503) else None
+            time.sleep(retry_after if retry_after is not None else self._backoff_seconds(attempt))
+
+    def vectorize_image_bytes(self, data: bytes, description: str = "the image"):
+        return self._post(
+            "vectorizeImage", description, data=data,
+            headers={"Content-type": "application/octet-stream"})
+
+    def vectorize_image_url(self, image_url: str):
+        return self._post("vectorizeImage", image_url, json={"url": image_url})
+
+    def vectorize_text(self, text: str):
+        return self._post("vectorizeText", f"the prompt '{text}'", json={"text": text})
+
+
+_embedding_clients = {}
+_embedding_clients_lock = threading.Lock()
+
+
+def get_embedding_client(endpoint: str, key: str, version: str):
+    """
+    Returns the shared EmbeddingClient for a Vision endpoint, key and API version.
+    """
+    with _embedding_clients_lock:
+        client = _embedding_clients.get((endpoint, key, version))
+        if client is None:
+            client = EmbeddingClient(endpoint, key, version)
+            _embedding_clients[(endpoint, key, version)] = client
+    return client
+
+
+def _vectorize_cached(kind, payload, endpoint, key, version, vectorize):
+    """
+    Returns the cached embedding of a request, or calls `vectorize` with the
+    endpoint's EmbeddingClient and caches its result.
+
+    Keys include the endpoint and the model version VISION_MODEL_VERSION last
+    resolved to; when a response reports another model, e.g. after "latest"
+    moved, the new version is recorded and vectors of the old model are no
+    longer used.
+    """
+    cache = get_embedding_cache()
+    model_version = cache.get_model_version(endpoint, VISION_MODEL_VERSION)
+    cached_vector = cache.get(cache.make_key(kind, payload, endpoint, version, model_version))
+    if cached_vector is not None:
+        return cached_vector
+
+    vector, resolved_version = vectorize(get_embedding_client(endpoint, key, version))
+    if resolved_version != model_version:
+        print(f"Vision model {VISION_MODEL_VERSION} on {endpoint} resolved to {resolved_version}")
+        cache.set_model_version(endpoint, VISION_MODEL_VERSION, resolved_version)
+    cache.put(cache.make_key(kind, payload, endpoint, version, resolved_version), vector)
+    return vector
 
 
 def vectorize_image_with_filepath(
@@ -18,33 +217,15 @@ def vectorize_image_with_filepath(
     :param key: The access key of the Azure AI Vision resource.
     :param version: The version of the API.
     :return: The vector embedding of the image.
+    :raises EmbeddingError: If the embedding could not be generated.
     """
     with open(image_filepath, "rb") as img:
         data = img.read()
 
-    # Vectorize Image API
-    version = f'?api-version={version}&modelVersion=latest'
-    vision_api = endpoint + "retrieval:vectorizeImage" + version
-
-    headers = {
-        "Content-type": "application/octet-stream",
-        "Ocp-Apim-Subscription-Key": key,
-    }
-
-    try:
-        r = requests.post(vision_api, data=data, headers=headers)
-        if r.status_code == 200:
-            image_vector = r.json()["vector"]
-            return image_vector
-        else:
-            print(
-                f"An error occurred while processing {image_filepath}. "
-                f"Error code: {r.status_code}."
-            )
-    except Exception as e:
-        print(f"An error occurred while processing {image_filepath}: {e}")
-
-    return None
+    # Keyed by the original bytes; the target size is part of the key as it changes the embedding
+    return _vectorize_cached(
+        f"image@{VISION_IMAGE_MAX_SIDE}", data, endpoint, key, version,
+        lambda client: client.vectorize_image_bytes(preprocess_for_vision(data).data, description=image_filepath))
 
 
 def vectorize_image_with_url(
@@ -62,30 +243,10 @@ def vectorize_image_with_url(
     :param key: The access key of the Azure AI Vision resource.
     :param version: The version of the API.
     :return: The vector embedding of the image.
+    :raises EmbeddingError: If the embedding could not be generated.
     """
-    # Vectorize Image API
-    version = f'?api-version={version}&modelVersion=latest'
-    vision_api = endpoint + "retrieval:vectorizeImage" + version
-
-    headers = {
-        "Content-type": "application/json",
-        "Ocp-Apim-Subscription-Key": key,
-    }
-
-    try:
-        r = requests.post(vision_api, json={"url": image_url}, headers=headers)
-        if r.status_code == 200:
-            image_vector = r.json()["vector"]
-            return image_vector
-        else:
-            print(
-                f"An error occurred while processing {image_url}. "
-                f"Error code: {r.status_code}."
-            )
-    except Exception as e:
-        print(f"An error occurred while processing {image_url}: {e}")
-
-    return None
+    return _vectorize_cached("url", image_url, endpoint, key, version,
+                             lambda client: client.vectorize_image_url(image_url))
 
 
 def vectorize_text(
@@ -103,30 +264,9 @@ def vectorize_text(
     :param key: The access key of the Azure AI Vision resource.
     :param version: The version of the API.
     :return: The vector embedding of the image.
+    :raises EmbeddingError: If the embedding could not be generated.
     """
-    # Vectorize Text API
-    version = f'?api-version={version}&modelVersion=latest'
-    vision_api = endpoint + "retrieval:vectorizeText" + version
-
-    headers = {
-        "Content-type": "application/json",
-        "Ocp-Apim-Subscription-Key": key
-    }
-
-    try:
-        r = requests.post(vision_api, json={"text": text}, headers=headers)
-        if r.status_code == 200:
-            text_vector = r.json()["vector"]
-            return text_vector
-        else:
-            print(
-                f"An error occurred while processing the prompt '{text}'. "
-                f"Error code: {r.status_code}."
-            )
-    except Exception as e:
-        print(f"An error occurred while processing the prompt '{text}': {e}")
-
-    return None
+    return _vectorize_cached("text", text, endpoint, key, version, lambda client: client.vectorize_text(text))
 
 
 def vectorize_image_with_gpt(folder_path=None, image_paths=None, b64s=None):
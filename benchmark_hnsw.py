@@ -0,0 +1,274 @@
+import argparse
+import itertools
+import json
+import os
+import time
+import numpy as np
+from azure.search.documents import SearchClient
+from azure.search.documents.models import VectorizedQuery
+from azure_embeddings import vectorize_image_with_filepath
+from image_data import images
+from search_backends import VECTOR_FIELD, LocalVectorIndex, build_ivf
+from utils import admin_client, azure_search_credential, build_search_index
+from vars import AZURE_SEARCH_INDEX_NAME, AZURE_SEARCH_SERVICE_ENDPOINT, LOCAL_INDEX_PATH, VISION_ENDPOINT, \
+    VISION_SUBSCRIPTION_KEY, VISION_VERSION
+
+# Optional (requirements-bench.txt): without it the local backend benchmarks the IVF index of LocalVectorIndex
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+
+# Parameter ranges accepted by Azure AI Search: m 4-10, ef_construction and ef_search 100-1000
+DEFAULT_GRID = {"m": [4, 8, 10], "ef_construction": [100, 400], "ef_search": [100, 500]}
+# Inverted lists scanned per query by the IVF stand-in
+DEFAULT_PROBES = [1, 4, 8, 16]
+
+
+def load_query_vectors(query_vectors_path=None, image_paths=None):
+    """
+    Loads the benchmark queries from a .npy file of embeddings, or embeds
+    query images with the Vision API (through the embedding cache).
+    """
+    if query_vectors_path:
+        return np.load(query_vectors_path).astype(np.float32)
+    image_paths = image_paths or [image["path"] for image in images]
+    return np.array([vectorize_image_with_filepath(path, VISION_ENDPOINT, VISION_SUBSCRIPTION_KEY, VISION_VERSION)
+                     for path in image_paths], dtype=np.float32)
+
+
+def exact_neighbors(vectors, queries, k):
+    """
+    Returns the exact cosine top-k row numbers of every query; `vectors` are
+    normalized rows.
+    """
+    queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    similarities = queries @ vectors.T
+    return np.argsort(-similarities, axis=1, kind="stable")[:, :k]
+
+
+def recall_at_k(found, expected):
+    """
+    Mean fraction of the expected neighbors found per query.
+    """
+    return float(np.mean([len(set(f) & set(e)) / max(len(e), 1) for f, e in zip(found, expected)]))
+
+
+def summarize(parameters, found, expected, latencies, build_seconds=None):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        **parameters,
+        "recall_at_k": recall_at_k(found, expected),
+        "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+        "latency_p95_ms": float(np.percentile(latencies_ms, 95)),
+        "build_seconds": build_seconds,
+    }
+
+
+def parameter_grid(grid):
+    names = ["m", "ef_construction", "ef_search"]
+    return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+
+def _exhaustive_baseline(vectors, queries, k):
+    expected = exact_neighbors(vectors, queries, k)
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        exact_neighbors(vectors, query[None, :], k)
+        latencies.append(time.perf_counter() - start)
+    return expected, summarize({"algorithm": "exhaustive_knn"}, expected, expected, latencies)
+
+
+def benchmark_local_ivf(corpus, queries, k, probes=DEFAULT_PROBES):
+    """
+    Benchmarks the IVF index of the local index, built here when the index
+    directory has none, at every number of probed lists against the exact
+    NumPy search. Needs no optional package.
+    """
+    vectors = np.asarray(corpus.vectors)
+    expected, baseline = _exhaustive_baseline(vectors, queries, k)
+    results = [baseline]
+
+    build_seconds = None
+    if corpus.lists is None:
+        start = time.perf_counter()
+        corpus.set_ivf(*build_ivf(vectors, max(1, int(np.sqrt(len(vectors))))))
+        build_seconds = time.perf_counter() - start
+    corpus.exact_max_rows = 0
+
+    for probe_count in probes:
+        corpus.probes = probe_count
+        found, latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            hits = corpus.search(query, top=k, select=["index_number"])
+            latencies.append(time.perf_counter() - start)
+            found.append([corpus.rows_by_key[hit["index_number"]] for hit in hits])
+        results.append(summarize({"algorithm": "ivf", "probes": probe_count}, found, expected, latencies,
+                                 build_seconds))
+        print(f"ivf probes={probe_count}: recall@{k} {results[-1]['recall_at_k']:.3f}, "
+              f"p50 {results[-1]['latency_p50_ms']:.2f}ms")
+    return results
+
+
+def benchmark_local(corpus, queries, k, grid):
+    """
+    Benchmarks hnswlib indexes over the local index vectors against the
+    exact NumPy search. hnswlib stands in for the service's HNSW implementation.
+    """
+    if hnswlib is None:
+        raise RuntimeError("The local HNSW benchmark needs the optional hnswlib package "
+                           "(pip install -r requirements-bench.txt).")
+
+    vectors = np.asarray(corpus.vectors)
+    expected, baseline = _exhaustive_baseline(vectors, queries, k)
+    results = [baseline]
+
+    for (m, ef_construction), points in itertools.groupby(
+            parameter_grid(grid), key=lambda point: (point["m"], point["ef_construction"])):
+        start = time.perf_counter()
+        index = hnswlib.Index(space="cosine", dim=vectors.shape[1])
+        index.init_index(max_elements=len(vectors), ef_construction=ef_construction, M=m)
+        index.add_items(vectors, np.arange(len(vectors)))
+        build_seconds = time.perf_counter() - start
+
+        for point in points:
+            index.set_ef(max(point["ef_search"], k))
+            found, latencies = [], []
+            for query in queries:
+                start = time.perf_counter()
+                labels, _ = index.knn_query(query, k=k)
+                latencies.append(time.perf_counter() - start)
+                found.append(labels[0])
+            results.append(summarize({"algorithm": "hnsw", **point}, found, expected, latencies, build_seconds))
+            print(f"hnsw {point}: recall@{k} {results[-1]['recall_at_k']:.3f}, "
+                  f"p50 {results[-1]['latency_p50_ms']:.2f}ms")
+    return results
+
+
+def _wait_for_documents(client, index_name, count, timeout_seconds=600):
+    deadline = time.time() + timeout_seconds
+    while client.get_document_count() < count:
+        if time.time() > deadline:
+            raise TimeoutError(f"Index {index_name} did not reach {count} documents in time.")
+        time.sleep(2)
+
+
+def _service_neighbors(client, query, k, exhaustive):
+    results = client.search(
+        vector_queries=[VectorizedQuery(vector=query.tolist(), k_nearest_neighbors=k, fields=VECTOR_FIELD,
+                                        exhaustive=exhaustive)],
+        select=["index_number"], top=k)
+    return [result["index_number"] for result in results]
+
+
+def _replay(client, queries, k, exhaustive=False):
+    found, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        found.append(_service_neighbors(client, query, k, exhaustive))
+        latencies.append(time.perf_counter() - start)
+    return found, latencies
+
+
+def benchmark_service(corpus, queries, k, grid, batch_size=500, keep_indexes=False):
+    """
+    Benchmarks Azure AI Search indexes built with every HNSW setting of the
+    grid; the ground truth is the exhaustive KNN query of the same index.
+
+    One index is built per (m, ef_construction) pair and its ef_search is
+    updated in place. The benchmark indexes are deleted afterwards unless
+    `keep_indexes` is set.
+    """
+    documents = [{**document, VECTOR_FIELD: vector.tolist()}
+                 for document, vector in zip(corpus.documents, np.asarray(corpus.vectors))]
+
+    results = []
+    for (m, ef_construction), points in itertools.groupby(
+            parameter_grid(grid), key=lambda point: (point["m"], point["ef_construction"])):
+        points = list(points)
+        index_name = f"{AZURE_SEARCH_INDEX_NAME}-bench-m{m}-efc{ef_construction}"
+        client = SearchClient(endpoint=AZURE_SEARCH_SERVICE_ENDPOINT, index_name=index_name,
+                              credential=azure_search_credential)
+        try:
+            start = time.perf_counter()
+            admin_client.create_or_update_index(build_search_index(name=index_name, hnsw_parameters=points[0]))
+            for i in range(0, len(documents), batch_size):
+                client.upload_documents(documents=documents[i:i + batch_size])
+            _wait_for_documents(client, index_name, len(documents))
+            build_seconds = time.perf_counter() - start
+
+            expected, latencies = _replay(client, queries, k, exhaustive=True)
+            if not results:
+                results.append(summarize({"algorithm": "exhaustive_knn"}, expected, expected, latencies))
+
+            for point in points:
+                admin_client.create_or_update_index(build_search_index(name=index_name, hnsw_parameters=point))
+                found, latencies = _replay(client, queries, k)
+                results.append(summarize({"algorithm": "hnsw", **point}, found, expected, latencies, build_seconds))
+                print(f"hnsw {point}: recall@{k} {results[-1]['recall_at_k']:.3f}, "
+                      f"p50 {results[-1]['latency_p50_ms']:.2f}ms")
+        finally:
+            if not keep_indexes:
+                admin_client.delete_index(index_name)
+    return results
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark recall@k and query latency of HNSW settings against exhaustive KNN.")
+    parser.add_argument("--backend", choices=["local", "service"], default="local",
+                        help="hnswlib over the local index, or Azure AI Search benchmark indexes. Without "
+                             "hnswlib (pip install -r requirements-bench.txt) the local backend benchmarks "
+                             "the IVF index of the local index instead.")
+    parser.add_argument("--corpus", default=LOCAL_INDEX_PATH,
+                        help="Local index directory holding the documents and vectors to index.")
+    parser.add_argument("--query-vectors", help=".npy file of query embeddings; defaults to embedding the "
+                                                "query product images of image_data.")
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--m", type=_int_list, default=DEFAULT_GRID["m"])
+    parser.add_argument("--ef-construction", type=_int_list, default=DEFAULT_GRID["ef_construction"])
+    parser.add_argument("--ef-search", type=_int_list, default=DEFAULT_GRID["ef_search"])
+    parser.add_argument("--probes", type=_int_list, default=DEFAULT_PROBES,
+                        help="Inverted lists scanned per query by the IVF fallback of the local backend.")
+    parser.add_argument("--keep-indexes", action="store_true", help="Keep the service benchmark indexes.")
+    parser.add_argument("--report", default=".cache/hnsw_benchmark.json")
+    args = parser.parse_args()
+
+    corpus = LocalVectorIndex(args.corpus)
+    queries = load_query_vectors(args.query_vectors)
+    grid = {"m": args.m, "ef_construction": args.ef_construction, "ef_search": args.ef_search}
+
+    if args.backend == "local" and hnswlib is None:
+        print("hnswlib is not installed; benchmarking the IVF index of the local index instead")
+        grid = {"probes": args.probes}
+        results = benchmark_local_ivf(corpus, queries, args.k, args.probes)
+    elif args.backend == "local":
+        results = benchmark_local(corpus, queries, args.k, grid)
+    else:
+        results = benchmark_service(corpus, queries, args.k, grid, keep_indexes=args.keep_indexes)
+
+    report = {
+        "backend": args.backend,
+        "k": args.k,
+        "documents": len(corpus),
+        "queries": len(queries),
+        "grid": grid,
+        "results": results,
+    }
+    directory = os.path.dirname(args.report)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(args.report, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {len(results)} results to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
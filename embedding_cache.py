@@ -0,0 +1,153 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from vars import EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES
+
+
+class EmbeddingCache:
+    """
+    Persistent, content-addressed cache for Azure AI Vision embeddings.
+
+    Vectors are stored as float32 blobs in SQLite and evicted least recently
+    used first once the cache holds more than `max_entries` vectors. The model
+    version an endpoint resolved a requested version such as "latest" to is
+    kept as well, so keys change when the service moves to another model.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        """
+        :param path: The SQLite database file to store the embeddings in.
+        :param max_entries: The maximum number of embeddings kept on disk.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS model_versions ("
+            "endpoint TEXT NOT NULL, requested TEXT NOT NULL, resolved TEXT NOT NULL, "
+            "PRIMARY KEY (endpoint, requested))"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(kind: str, payload, endpoint: str, api_version: str, model_version: str):
+        """
+        Builds the cache key for an embedding request.
+
+        :param kind: The kind of input ("image", "url" or "text").
+        :param payload: The image bytes, image URL or text prompt.
+        :param endpoint: The endpoint of the Azure AI Vision resource.
+        :param api_version: The version of the Vision API.
+        :param model_version: The resolved version of the embedding model, see get_model_version.
+        :return: A hex digest identifying the request.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+
+        digest = hashlib.sha256()
+        digest.update(f"{kind}\0{endpoint}\0{api_version}\0{model_version}\0".encode("utf-8"))
+        digest.update(payload)
+        return digest.hexdigest()
+
+    def get_model_version(self, endpoint: str, requested: str):
+        """
+        Returns the model version `requested` last resolved to on `endpoint`,
+        or `requested` itself before the first response.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT resolved FROM model_versions WHERE endpoint = ? AND requested = ?",
+                (endpoint, requested)).fetchone()
+        return row[0] if row else requested
+
+    def set_model_version(self, endpoint: str, requested: str, resolved: str):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO model_versions (endpoint, requested, resolved) VALUES (?, ?, ?)",
+                (endpoint, requested, resolved))
+            self._connection.commit()
+
+    def get(self, key: str):
+        """
+        Returns the cached vector for `key`, or None on a miss.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._connection.execute(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            self.hits += 1
+
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector.tolist()
+
+    def put(self, key: str, vector):
+        """
+        Stores `vector` under `key` and evicts the least recently used entries
+        when the cache is over capacity.
+        """
+        blob = array("f", vector).tobytes()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                (key, blob, time.time()))
+
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if count > self.max_entries:
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,))
+            self._connection.commit()
+
+    def stats(self):
+        """
+        Returns the hit/miss counters and the number of stored embeddings.
+        """
+        with self._lock:
+            (entries,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    Returns the process-wide embedding cache.
+    """
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_ENTRIES)
+    return _embedding_cache
+
+
+def format_embedding_cache_stats():
+    stats = get_embedding_cache().stats()
+    lookups = stats["hits"] + stats["misses"]
+    return (f"{stats['hits']}/{lookups} embedding cache hits, {stats['misses']} vectorized, "
+            f"{stats['entries']} cached")
@@ -0,0 +1,37 @@
+import argparse
+import time
+from search_backends import RESULT_FIELDS, VECTOR_FIELD, write_local_index
+from utils import search_client
+from vars import LOCAL_INDEX_PATH, LOCAL_INDEX_IVF_MIN_DOCUMENTS
+
+
+def iter_index_documents():
+    """
+    Yields every document of the Azure AI Search index, including its vector.
+
+    The vector field has to be retrievable. Paging relies on skip, which the
+    service caps at 100,000 documents.
+    """
+    results = search_client.search(search_text="*", select=RESULT_FIELDS + [VECTOR_FIELD], top=None)
+    for page in results.by_page():
+        for document in page:
+            if not document.get(VECTOR_FIELD):
+                raise ValueError(f"Document {document.get('index_number')} was returned without its vector; "
+                                 f"exporting needs an index with retrievable vectors (SEARCH_VECTOR_RETRIEVABLE).")
+            yield document
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the Azure AI Search index to a local vector index.")
+    parser.add_argument("--output", default=LOCAL_INDEX_PATH, help="The local index directory.")
+    parser.add_argument("--ivf-min-documents", type=int, default=LOCAL_INDEX_IVF_MIN_DOCUMENTS,
+                        help="Build an approximate (IVF) index for indexes of at least this many documents.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    exported = write_local_index(args.output, iter_index_documents(), args.ivf_min_documents)
+    print(f"Exported {exported} documents to {args.output} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
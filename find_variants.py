@@ -0,0 +1,152 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from image_preprocess import preprocess_for_gpt
+from primary_images import get_primary_image_sas_urls
+from rerank import rerank_candidates
+from search_backends import QUERY_PLANS, build_query_text
+from utils import similarity_search_pages
+from vars import BLOB_CONNECTION_STRING, RERANK_MODE, SEARCH_PAGE_SIZE, SEARCH_QUERY_PLAN
+
+
+@dataclass
+class FindVariantsResult:
+    """
+    Outcome of a Find Variants query.
+
+    :param candidates: The search results, in similarity order.
+    :param results: The results to display, best first.
+    :param image_urls: The display image URL of every entry of `results`.
+    :param rerank: The RerankResult, or None when there was nothing to rank.
+    :param timings: Seconds spent per stage, plus the end-to-end "total".
+    """
+    candidates: list = field(default_factory=list)
+    results: list = field(default_factory=list)
+    image_urls: list = field(default_factory=list)
+    rerank: object = None
+    timings: dict = field(default_factory=dict)
+
+
+async def _timed(timings, stage, function, *args, **kwargs):
+    """
+    Runs a blocking stage in a worker thread and records its duration.
+    """
+    start = time.perf_counter()
+    try:
+        return await asyncio.to_thread(function, *args, **kwargs)
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+
+def _read_bytes(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+async def afind_variants(image_path, product_info, display_width=None, rerank_mode=RERANK_MODE,
+                         on_candidates=None, on_result=None, page_size=SEARCH_PAGE_SIZE,
+                         query_plan=SEARCH_QUERY_PLAN, **rerank_options):
+    """
+    Runs the Find Variants query with independent stages overlapped.
+
+    The GPT image encoding runs while the image is embedded and searched, and
+    the display URLs of the candidates are resolved while the rerank call is
+    in flight, so the latency follows the slowest branch instead of the sum
+    of all stages. The first page of search results is shown while the
+    remaining results, fetched in one background request, arrive for the rerank.
+
+    :param image_path: The query image filepath.
+    :param product_info: The query product's metadata (category, brand, ...).
+    :param display_width: The width the result images are displayed at.
+    :param rerank_mode: The rerank stage, see rerank.rerank_candidates.
+    :param on_candidates: Optional callback receiving the first page of
+        candidates in similarity order and their image URLs as soon as both
+        are known, before the rerank runs.
+    :param on_result: Optional callback receiving each ranked candidate and its
+        image URL as soon as the streamed rerank reply names it.
+    :param page_size: The number of search results per page.
+    :param query_plan: The search query plan, see search_backends.QUERY_PLANS.
+    :param rerank_options: Options passed to the rerank stage.
+    :return: A FindVariantsResult.
+    :raises EmbeddingError: If the query image could not be embedded.
+    :raises openai.APIError: If the rerank call failed.
+    """
+    start = time.perf_counter()
+    timings = {}
+
+    image_bytes = await _timed(timings, "read_image", _read_bytes, image_path)
+    # The prepared image lands in the preprocessing cache the rerank reads from
+    encode_task = asyncio.create_task(_timed(timings, "encode_image", preprocess_for_gpt, image_bytes))
+    try:
+        pages = await _timed(timings, "embed", similarity_search_pages,
+                             image_path, product_info['category'], product_info['brand'],
+                             page_size=page_size, query_plan=query_plan, query_text=build_query_text(product_info))
+        first_page = await _timed(timings, "search_first_page", pages.next_page)
+    finally:
+        await encode_task
+
+    if not first_page:
+        timings["total"] = time.perf_counter() - start
+        return FindVariantsResult(timings=timings)
+
+    first_page_urls = await _timed(timings, "first_page_image_urls", get_primary_image_sas_urls,
+                                   BLOB_CONNECTION_STRING,
+                                   [candidate['product_folder_link'] for candidate in first_page], display_width)
+    if on_candidates is not None:
+        on_candidates(first_page, first_page_urls)
+        timings["first_paint"] = time.perf_counter() - start
+
+    candidates = await _timed(timings, "search_remaining_pages", pages.fetch_all)
+    result = FindVariantsResult(candidates=candidates, timings=timings)
+
+    if on_result is not None:
+        # The rerank runs in a worker thread; callbacks run on the event loop's
+        # thread, which is the thread the caller (e.g. the Streamlit script) owns
+        loop = asyncio.get_running_loop()
+        ranked = asyncio.Queue()
+        rerank_options["on_index"] = lambda index: loop.call_soon_threadsafe(ranked.put_nowait, index)
+
+    # Score gaps only mark a natural cut-off when the scores are similarities
+    rerank_options.setdefault("score_ordered", QUERY_PLANS[query_plan]["similarity_scores"])
+    rerank_task = asyncio.create_task(
+        _timed(timings, "rerank", rerank_candidates, candidates, image_path, product_info,
+               mode=rerank_mode, **rerank_options))
+    try:
+        image_urls = first_page_urls + await _timed(
+            timings, "image_urls", get_primary_image_sas_urls, BLOB_CONNECTION_STRING,
+            [candidate['product_folder_link'] for candidate in candidates[len(first_page):]], display_width)
+
+        if on_result is not None:
+            while not (rerank_task.done() and ranked.empty()):
+                next_index = asyncio.create_task(ranked.get())
+                await asyncio.wait({next_index, rerank_task}, return_when=asyncio.FIRST_COMPLETED)
+                if not next_index.done():
+                    next_index.cancel()
+                    continue
+                index = next_index.result()
+                if "first_result" not in timings:
+                    timings["first_result"] = time.perf_counter() - start
+                on_result(candidates[index], image_urls[index])
+        rerank_result = await rerank_task
+    finally:
+        if not rerank_task.done():
+            rerank_task.cancel()
+
+    order = rerank_result.indices or list(range(len(candidates)))
+    result.results = [candidates[i] for i in order]
+    result.image_urls = [image_urls[i] for i in order]
+    result.rerank = rerank_result
+    timings["total"] = time.perf_counter() - start
+    return result
+
+
+def find_variants(image_path, product_info, display_width=None, rerank_mode=RERANK_MODE, **rerank_options):
+    """
+    Blocking entry point of afind_variants, for callers without an event loop
+    such as the Streamlit script.
+    """
+    return asyncio.run(afind_variants(image_path, product_info, display_width, rerank_mode, **rerank_options))
+
+
+def format_timings(timings):
+    return ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items())
@@ -1,12 +1,91 @@
-from openai import AzureOpenAI
+from openai import AzureOpenAI, AsyncAzureOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 import os
+import re
+import json
+import time
+import asyncio
 import base64
+import threading
+import weakref
+import httpx
 import requests
-from vars import AZURE_OPENAI_AI_VERSION, AZURE_OPENAI_API_KEY, AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_NAME
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from image_preprocess import preprocess_for_gpt
+from rerank_cache import get_rerank_cache
+from vars import AZURE_OPENAI_AI_VERSION, AZURE_OPENAI_API_KEY, AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_NAME, \
+    RERANK_RESPONSE_FORMAT, AZURE_OPENAI_MAX_RETRIES, RERANK_SHARDS, RERANK_FUSION, \
+    AZURE_OPENAI_MAX_CONNECTIONS, AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS, AZURE_OPENAI_CONNECT_TIMEOUT, \
+    AZURE_OPENAI_READ_TIMEOUT
 
-def encode_image(image_path):
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+# Async clients hold connections bound to the event loop that opened them
+_async_openai_clients = weakref.WeakKeyDictionary()
+
+
+def _openai_client_options():
+    return {
+        "azure_endpoint": AZURE_OPENAI_ENDPOINT,
+        "api_key": AZURE_OPENAI_API_KEY,
+        "api_version": AZURE_OPENAI_AI_VERSION,
+        # The client retries connection errors, timeouts, 429 and 5xx responses itself
+        "max_retries": AZURE_OPENAI_MAX_RETRIES,
+        "timeout": httpx.Timeout(AZURE_OPENAI_READ_TIMEOUT, connect=AZURE_OPENAI_CONNECT_TIMEOUT),
+    }
+
+
+def _openai_connection_limits():
+    return httpx.Limits(max_connections=AZURE_OPENAI_MAX_CONNECTIONS,
+                        max_keepalive_connections=AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS)
+
+
+def get_openai_client():
+    """
+    Returns the process-wide AzureOpenAI client, whose connection pool is
+    shared by every call and thread.
+    """
+    global _openai_client
+    with _openai_client_lock:
+        if _openai_client is None:
+            _openai_client = AzureOpenAI(
+                http_client=DefaultHttpxClient(limits=_openai_connection_limits()),
+                **_openai_client_options())
+    return _openai_client
+
+
+def get_async_openai_client():
+    """
+    Returns the AsyncAzureOpenAI client of the running event loop. Call
+    close_async_openai_client before the loop ends to release its connections.
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_openai_clients.get(loop)
+    if client is None:
+        client = AsyncAzureOpenAI(
+            http_client=DefaultAsyncHttpxClient(limits=_openai_connection_limits()),
+            **_openai_client_options())
+        _async_openai_clients[loop] = client
+    return client
+
+
+async def close_async_openai_client():
+    """
+    Closes the AsyncAzureOpenAI client of the running event loop, if it has one.
+    """
+    client = _async_openai_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
+
+
+def encode_image_data_url(image_path):
+    """
+    Returns a data URL of a local image, downsized for the vision model and
+    labelled with its actual MIME type.
+    """
     with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+        return preprocess_for_gpt(image_file.read()).to_data_url()
 
 
 def url_to_base64(image_url):
@@ -19,43 +98,76 @@ def url_to_base64(image_url):
             f"Failed to retrieve image. Status code: {response.status_code}")
 
 
-def get_text_api_result(prompt, base64_images=None):
-    completion_client = AzureOpenAI(
-        azure_endpoint = AZURE_OPENAI_ENDPOINT,
-        api_key = AZURE_OPENAI_API_KEY,
-        api_version = AZURE_OPENAI_AI_VERSION
-    )
+def _build_messages(prompt, base64_images=None):
+    if not base64_images:
+        return [
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
 
-    if base64_images:
-        attachments = [{"type": "text", "text": prompt}]
-        for base64_image in base64_images:
-            attachments.append(
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_image}"
-                    }
-                }
-            )
-        completion = completion_client.chat.completions.create(
-            model = AZURE_OPENAI_NAME,
-            messages=[
-                {
-                    "role": "user",
-                    "content": attachments
-                }
-            ]
-        )
-    else:
-        completion = completion_client.chat.completions.create(
-            model = AZURE_OPENAI_NAME,
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
+    attachments = [{"type": "text", "text": prompt}]
+    for base64_image in base64_images:
+        # Accepts ready-made data URLs as well as bare base64 JPEG payloads
+        image_url = base64_image if base64_image.startswith("data:") else f"data:image/jpeg;base64,{base64_image}"
+        attachments.append(
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": image_url
                 }
-            ]
+            }
         )
+    return [
+        {
+            "role": "user",
+            "content": attachments
+        }
+    ]
+
+
+def get_text_api_result(prompt, base64_images=None, response_format=None):
+    extra_arguments = {"response_format": response_format} if response_format else {}
+    completion = get_openai_client().chat.completions.create(
+        model = AZURE_OPENAI_NAME,
+        messages=_build_messages(prompt, base64_images),
+        **extra_arguments
+    )
+
+    return completion.choices[0].message.content
+
+
+def stream_text_api_result(prompt, base64_images=None, response_format=None):
+    """
+    Streaming variant of get_text_api_result that yields the reply text in
+    chunks as the model produces it.
+    """
+    extra_arguments = {"response_format": response_format} if response_format else {}
+    stream = get_openai_client().chat.completions.create(
+        model = AZURE_OPENAI_NAME,
+        messages=_build_messages(prompt, base64_images),
+        stream=True,
+        **extra_arguments
+    )
+
+    for chunk in stream:
+        # Azure sends chunks without choices, e.g. the prompt content filter results
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def aget_text_api_result(prompt, base64_images=None, response_format=None):
+    """
+    Coroutine variant of get_text_api_result, for callers that keep many
+    requests in flight on one event loop.
+    """
+    extra_arguments = {"response_format": response_format} if response_format else {}
+    completion = await get_async_openai_client().chat.completions.create(
+        model = AZURE_OPENAI_NAME,
+        messages=_build_messages(prompt, base64_images),
+        **extra_arguments
+    )
 
     return completion.choices[0].message.content
 
@@ -68,22 +180,33 @@ tagging_prompt = """Analyze the provided images meticulously and extract detaile
     Provide the extracted text in a clear, organized format
 
 """
-prompt = "Create a detailed product description with the information from these images. Ensure the text is unformatted, without any bold, italic, or other special formatting."
-
+DESCRIPTION_PROMPT = "Create a detailed product description with the information from these images. Ensure the text is unformatted, without any bold, italic, or other special formatting."
 
-def generate_item_description(folder_path=None, b64s=None, image_paths=None):
-    # prompt = "Analyze the provided set of images and generate a structured and detailed description that includes only the product's nutritional values, ingredients, serving sizes, packaging claims, allergen information, and other relevant details. Do not include any additional commentary, concluding statements, or extraneous text beyond the factual information presented in the images. Ensure the text is unformatted, without any bold, italic, or other special formatting."
-    prompt = "Create a detailed product description with the information from these images. Ensure the text is unformatted, without any bold, italic, or other special formatting."
 
+def _description_images(folder_path=None, b64s=None, image_paths=None):
     if not b64s:
         # files = [f"{folder_path}/{file}" for file in os.listdir(folder_path)]
-        files = [f"{folder_path}/{file}" for file in os.listdir(
-            folder_path) if not file.lower().endswith('.json')]
         if image_paths is not None:
             files = image_paths
-        b64s = [encode_image(file) for file in files]
+        else:
+            files = [f"{folder_path}/{file}" for file in os.listdir(
+                folder_path) if not file.lower().endswith('.json')]
+        b64s = [encode_image_data_url(file) for file in files]
+    return b64s
+
+
+def generate_item_description(folder_path=None, b64s=None, image_paths=None, prompt=DESCRIPTION_PROMPT):
+    # prompt = "Analyze the provided set of images and generate a structured and detailed description that includes only the product's nutritional values, ingredients, serving sizes, packaging claims, allergen information, and other relevant details. Do not include any additional commentary, concluding statements, or extraneous text beyond the factual information presented in the images. Ensure the text is unformatted, without any bold, italic, or other special formatting."
+    return get_text_api_result(prompt, _description_images(folder_path, b64s, image_paths))
+
 
-    return get_text_api_result(prompt, b64s)
+async def agenerate_item_description(folder_path=None, b64s=None, image_paths=None, prompt=DESCRIPTION_PROMPT):
+    """
+    Coroutine variant of generate_item_description; image encoding runs in a
+    worker thread so the event loop stays free.
+    """
+    images = await asyncio.to_thread(_description_images, folder_path, b64s, image_paths)
+    return await aget_text_api_result(prompt, images)
 
 
 # def generate_filtered_search_results(items, instruction):
@@ -100,31 +223,262 @@ def generate_item_description(folder_path=None, b64s=None, image_paths=None):
 #     return get_text_api_result(prompt)
 
 
-def generate_top_n_search_results(items, image_path):
+# Bump whenever the rerank prompt changes so cached replies are not reused
+TOP_N_PROMPT_VERSION = "top-n-v2"
+
+TOP_N_JSON_SCHEMA = {
+    "name": "ranked_items",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {"items": {"type": "array", "items": {"type": "integer"}}},
+        "required": ["items"],
+        "additionalProperties": False,
+    },
+}
+
+
+@dataclass
+class RerankResult:
+    """
+    Outcome of a rerank call.
+
+    :param indices: Zero-based positions of the ranked candidates, best first.
+    :param reply: The raw model reply.
+    :param latency_seconds: Wall-clock time of the rerank, including cache lookups.
+    :param cached: Whether the reply came from the rerank cache.
+    """
+    indices: list = field(default_factory=list)
+    reply: str = ""
+    latency_seconds: float = 0.0
+    cached: bool = False
+
+
+def parse_rerank_indices(reply, count):
+    """
+    Tolerantly parses a rerank reply into zero-based candidate positions.
+
+    Accepts a JSON object holding a list of integers, a bare JSON list or any
+    text containing item numbers. Duplicates and out-of-range numbers are dropped.
+
+    :param reply: The model reply.
+    :param count: The number of candidates that were sent.
+    :return: The ranked zero-based positions, best first.
+    """
+    numbers = None
+    try:
+        parsed = json.loads(reply)
+        if isinstance(parsed, dict):
+            parsed = next((value for value in parsed.values() if isinstance(value, list)), None)
+        if isinstance(parsed, list):
+            numbers = [int(number) for number in parsed
+                       if isinstance(number, int) or (isinstance(number, str) and number.strip().isdigit())]
+    except (TypeError, ValueError):
+        pass
+
+    if numbers is None:
+        numbers = [int(number) for number in re.findall(r"\d+", reply or "")]
+
+    indices = []
+    seen = set()
+    for number in numbers:
+        if 1 <= number <= count and number not in seen:
+            seen.add(number)
+            indices.append(number - 1)
+    return indices
+
+
+class IncrementalIndexParser:
+    """
+    Extracts item numbers from a streamed rerank reply as soon as each of
+    them is complete, with the same rules as parse_rerank_indices.
+    """
+
+    def __init__(self, count):
+        """
+        :param count: The number of candidates that were sent.
+        """
+        self.count = count
+        self.indices = []
+        self._seen = set()
+        self._digits = ""
+
+    def _emit(self):
+        number, self._digits = self._digits, ""
+        if number and 1 <= int(number) <= self.count and int(number) not in self._seen:
+            self._seen.add(int(number))
+            self.indices.append(int(number) - 1)
+            return [int(number) - 1]
+        return []
+
+    def feed(self, text):
+        """
+        Consumes the next chunk of the reply.
+
+        :return: The zero-based positions completed by this chunk, in order.
+        """
+        new_indices = []
+        for character in text:
+            if character.isdigit():
+                self._digits += character
+            else:
+                new_indices += self._emit()
+        return new_indices
+
+    def close(self):
+        """
+        Flushes a number at the very end of the reply.
+        """
+        return self._emit()
+
+
+def _top_n_response_format():
+    if RERANK_RESPONSE_FORMAT == "json_schema":
+        return {"type": "json_schema", "json_schema": TOP_N_JSON_SCHEMA}
+    return {"type": "json_object"}
+
+
+# Constant of reciprocal rank fusion, score = 1 / (RRF_K + rank)
+RRF_K = 60
+# Shards are only used when each of them gets at least this many candidates
+MIN_SHARD_SIZE = 5
+# Winners per shard that enter the final tournament call
+TOURNAMENT_WINNERS_PER_SHARD = 3
+
+
+def _rank_items(items, image_bytes, candidate_ids=None, on_index=None):
+    """
+    Ranks one list of candidate items against the query image with a single
+    (cached) model call.
+
+    With `on_index` the reply is streamed and the callback receives every
+    ranked position as soon as it is parsed.
+    """
+    start = time.perf_counter()
+    count = len(items)
+
+    cache = get_rerank_cache()
+    cache_key = cache.make_key(image_bytes, candidate_ids, items, TOP_N_PROMPT_VERSION, AZURE_OPENAI_NAME)
+    cached_reply = cache.get(cache_key)
+    if cached_reply is not None:
+        indices = parse_rerank_indices(cached_reply, count)
+        if on_index is not None:
+            for index in indices:
+                on_index(index)
+        return RerankResult(indices, cached_reply, time.perf_counter() - start, cached=True)
+
     item_list = ''
     for i, item in enumerate(items, start=1):
         item_list += f'ITEM {i}: {item.strip()}\n\n'
-    count = len(items)
-    
-    # prompt = (
-    #     f"You are a highly skilled food suggestion expert. From the given input's metadata: Flavour: {flavour} ; Quantity: {quantity} Oz,"
-    #     f"Idenify and return the top {count} ranked (best to worst) most relevant item numbers. The output should strictly follow this format: [item_number1, item_number2, ...]. "
-    #     f"If there are fewer than {count} relevant items, return as many as are available in the correct format but try to return {count} unless you find results to be completely irrelevant. "
-    #     f"Even if you find some exact matches, then you can still look for other items that could potentially be similar based on the description of the item."
-    #     f"For example, if the relevant items are Item No 1, Item No 3, Item No 6, Item No 12, and Item No 22, the output should be [1, 3, 6, 12, 22]. "
-    #     f"Do not include any additional information or text.\nItems:\n"
-    #     f"{item_list}"
-    # )
     
     prompt = (
         f"You are a highly skilled food suggestion expert. From the given input image,"
-        f"Identify and return the top {count} ranked (best to worst) most relevant item numbers that belong to the same category as the input item (e.g., chips, dips, etc.). The output should strictly follow this format: [item_number1, item_number2, ...]. "
+        f"Identify and return the top {count} ranked (best to worst) most relevant item numbers that belong to the same category as the input item (e.g., chips, dips, etc.). "
         f"Ensure that the results come from the same inferred category as the input and exclude items from any oher category. "
-        f"If there are fewer than {count} relevant items in the same category, return as many as are available in the correct format but do not include items from different categories even if fewer results are returned. "
-        f"For example, if the relevant items are Item No 1, Item No 3, Item No 6, Item No 12, and Item No 22, the output should be [1, 3, 6, 12, 22]. "
+        f"If there are fewer than {count} relevant items in the same category, return as many as are available but do not include items from different categories even if fewer results are returned. "
+        f"Respond with a JSON object of the form {{\"items\": [item_number1, item_number2, ...]}}. "
+        f"For example, if the relevant items are Item No 1, Item No 3, Item No 6, Item No 12, and Item No 22, the output should be {{\"items\": [1, 3, 6, 12, 22]}}. "
         f"Do not include any additional information or text.\nItems:\n"
         f"{item_list}"
     )
     
-    return get_text_api_result(prompt, [encode_image(image_path)])
+    images = [preprocess_for_gpt(image_bytes).to_data_url()]
+    if on_index is None:
+        reply = get_text_api_result(prompt, images, response_format=_top_n_response_format())
+    else:
+        parser = IncrementalIndexParser(count)
+        chunks = []
+        for chunk in stream_text_api_result(prompt, images, response_format=_top_n_response_format()):
+            chunks.append(chunk)
+            for index in parser.feed(chunk):
+                on_index(index)
+        for index in parser.close():
+            on_index(index)
+        reply = "".join(chunks)
+    indices = parse_rerank_indices(reply, count)
+    if indices:
+        cache.put(cache_key, reply)
+    return RerankResult(indices, reply, time.perf_counter() - start)
+
+
+def reciprocal_rank_fusion(rankings):
+    """
+    Merges rankings of candidate positions with reciprocal rank fusion.
+
+    :param rankings: Lists of candidate positions, best first.
+    :return: The merged positions, best first; ties keep search order.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, position in enumerate(ranking, start=1):
+            scores[position] = scores.get(position, 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(scores, key=lambda position: (-scores[position], position))
+
+
+def generate_top_n_search_results(items, image_path, candidate_ids=None, shards=RERANK_SHARDS,
+                                  fusion=RERANK_FUSION, on_index=None):
+    """
+    Asks the multimodal model to rank the candidate items against the query image.
+
+    The model is asked for structured JSON output and the reply is parsed
+    tolerantly; transport failures are retried by the client, formatting
+    deviations are salvaged instead of re-issuing the call. Replies that yield
+    a ranking are cached by image content, candidates, prompt version and
+    deployment, so repeat queries skip the model call.
+
+    With `shards` > 1 the candidates are dealt round-robin into that many
+    groups that are ranked concurrently, so the rerank time follows the shard
+    size rather than the total number of candidates. The partial rankings are
+    merged with reciprocal rank fusion ("rrf"), or with a final "tournament"
+    call over the top candidates of every shard followed by the RRF order.
+
+    :param items: The candidate descriptions, in search order.
+    :param image_path: The query image filepath.
+    :param candidate_ids: The index_number values of the candidates, in the same order.
+    :param shards: The number of concurrent rerank calls.
+    :param fusion: "rrf" or "tournament".
+    :param on_index: Optional callback receiving each ranked position as soon
+        as it is known. A single call is streamed; sharded rankings are only
+        known once they are fused.
+    :return: A RerankResult.
+    """
+    if fusion not in ("rrf", "tournament"):
+        raise ValueError(f"Unknown rerank fusion '{fusion}'. Expected 'rrf' or 'tournament'.")
+
+    start = time.perf_counter()
+    with open(image_path, "rb") as image_file:
+        image_bytes = image_file.read()
+
+    shards = max(1, min(shards, len(items) // MIN_SHARD_SIZE))
+    if shards == 1:
+        return _rank_items(items, image_bytes, candidate_ids, on_index)
+
+    shard_positions = [list(range(shard, len(items), shards)) for shard in range(shards)]
+
+    def rank_shard(positions):
+        return _rank_items([items[i] for i in positions], image_bytes,
+                           [candidate_ids[i] for i in positions] if candidate_ids else None)
+
+    with ThreadPoolExecutor(max_workers=shards) as executor:
+        shard_results = list(executor.map(rank_shard, shard_positions))
+
+    rankings = [[positions[i] for i in result.indices]
+                for positions, result in zip(shard_positions, shard_results)]
+    indices = reciprocal_rank_fusion(rankings)
+    replies = [result.reply for result in shard_results]
+    cached = all(result.cached for result in shard_results)
+
+    if fusion == "tournament":
+        winners = [position for ranking in rankings for position in ranking[:TOURNAMENT_WINNERS_PER_SHARD]]
+        if len(winners) > 1:
+            final_result = rank_shard(winners)
+            final_order = [winners[i] for i in final_result.indices]
+            finalists = set(final_order)
+            indices = final_order + [position for position in indices if position not in finalists]
+            replies.append(final_result.reply)
+            cached = cached and final_result.cached
 
+    if on_index is not None:
+        for index in indices:
+            on_index(index)
+    return RerankResult(indices, "\n".join(replies), time.perf_counter() - start, cached)
@@ -1,81 +1,186 @@
-from PIL import Image
-import base64
-import io
 import streamlit as st
-import math
-from azure_blob_storage import parse_blob_url, list_blob_sas_urls_from_folder
+import openai
+from primary_images import get_primary_image_sas_urls
+from thumbnails import encode_local_thumbnail, local_image_data_uri
 from vars import BLOB_CONNECTION_STRING
-from gpt_gen import generate_top_n_search_results
-from utils import similarity_search_via_image
+from find_variants import find_variants, format_timings
+from image_preprocess import format_preprocess_stats
+from precompute import get_current_index_version, get_stored_image_urls, refresh_in_background, store_variants
+from result_store import ResultStore, get_result_store
+from azure_embeddings import EmbeddingError
 from image_data import mapped_data, images
-from collections import Counter
+
+
+RESULT_IMAGE_WIDTH = 150
+RESULT_COLUMNS = 5
+# Results shown initially and added per "Load more" click
+RESULT_PAGE_SIZE = 20
+# Selection grid tiles take half of a wide-layout column; encoded at 2x for high-DPI screens
+CLICKABLE_IMAGE_WIDTH = 400
+SELECTED_IMAGE_WIDTH = 300
 
 
 def clickable_image(image_path, action_name):
     
-        image = Image.open(image_path)
-        buffered = io.BytesIO()
-        image.save(buffered, format="PNG")
-        image_base64 = base64.b64encode(buffered.getvalue()).decode()
+        image_data_uri = local_image_data_uri(image_path, CLICKABLE_IMAGE_WIDTH)
 
         # Create a clickable image using HTML
         image_html = f'''
         <a href="{action_name}">
-            <img src="data:image/png;base64,{image_base64}" style="width:50%; height:auto;"/>
+            <img src="{image_data_uri}" style="width:50%; height:auto;"/>
         </a>
         '''
         st.markdown(image_html, unsafe_allow_html=True)
         
-def display_images(relevant_context):
-        for k in range(math.ceil(len(relevant_context)/5)):
-            columns = st.columns(5)
-            j = 0
-            for i, context in enumerate(relevant_context[5*k:5*(k+1)]):
-                container_name, folder_name = parse_blob_url(
-                    context['product_folder_link'])
-                image_url = list_blob_sas_urls_from_folder(BLOB_CONNECTION_STRING, container_name, folder_name)[0]
-
-                # Display images in the second row
-                with columns[j]:
-                    st.image(image_url, width=150)
-                    caption = f"""
-                    **Brand**: {context['brand']}  <br>
-                    **Flavour**: {context['flavour']}  <br>
-                    **Quantity**: {context['quantity']} Oz  <br>
-                    """
-                    st.markdown(caption, unsafe_allow_html=True)
-                j += 1
+def display_tile(context, image_url):
+    if image_url:
+        st.image(image_url, width=RESULT_IMAGE_WIDTH)
+    caption = f"""
+    **Brand**: {context['brand']}  <br>
+    **Flavour**: {context['flavour']}  <br>
+    **Quantity**: {context['quantity']} Oz  <br>
+    """
+    st.markdown(caption, unsafe_allow_html=True)
+
+
+class ResultGrid:
+    """
+    Appends result tiles to a container, RESULT_COLUMNS per row, so results
+    can be shown one by one as they arrive.
+    """
+
+    def __init__(self, container):
+        self.container = container
+        self.columns = []
+        self.count = 0
+
+    def add(self, context, image_url):
+        if self.count % RESULT_COLUMNS == 0:
+            self.columns = self.container.columns(RESULT_COLUMNS)
+        with self.columns[self.count % RESULT_COLUMNS]:
+            display_tile(context, image_url)
+        self.count += 1
+
+
+def display_images(relevant_context, image_urls=None, container=None):
+        if image_urls is None:
+            # Resolve the primary image of every result up front, without a listing per result
+            image_urls = get_primary_image_sas_urls(
+                BLOB_CONNECTION_STRING, [context['product_folder_link'] for context in relevant_context],
+                display_width=RESULT_IMAGE_WIDTH)
+
+        grid = ResultGrid(container if container is not None else st.container())
+        for context, image_url in zip(relevant_context, image_urls):
+            grid.add(context, image_url)
                 
                 
+def _show_more_results(visible_key):
+    st.session_state[visible_key] = st.session_state.get(visible_key, RESULT_PAGE_SIZE) + RESULT_PAGE_SIZE
+
+
+def visible_result_count(selected_image_path):
+    return st.session_state.get(f"visible_results_{selected_image_path}", RESULT_PAGE_SIZE)
+
+
+def display_result_page(selected_image_path, results, image_urls=None, container=None):
+    """
+    Shows the first results of a query, one more page per "Load more" click.
+    The results are already complete and ranked, so pages are slices of them.
+    """
+    container = container if container is not None else st.container()
+    visible = visible_result_count(selected_image_path)
+    display_images(results[:visible], image_urls[:visible] if image_urls else None, container)
+    if len(results) > visible:
+        container.button("Load more", key=f"load_more_{selected_image_path}", on_click=_show_more_results,
+                         args=(f"visible_results_{selected_image_path}",))
+
+
 def on_click(selected_image_path):
     product_info = mapped_data[selected_image_path]
     # print(product_info)
-    relevant_context = similarity_search_via_image(selected_image_path, product_info['category'], product_info['brand'])
-    # print(relevant_context)
-    
-    product_description_list = [
-        f"Product Description: {result['product_description']}\n\nFlavour: {result['flavour']}\n Quantity: {result['quantity']}" for result in relevant_context
-    ]
-
-    # print(product_description_list)
-
-    for i in range(4):
-        try:
-            second_filter_items = generate_top_n_search_results(product_description_list, selected_image_path)
-            integer_list = list(map(lambda x: int(x) - 1, second_filter_items.strip("[]").split(", ")))
-            
-            repeated_items = {item: count for item, count in Counter(integer_list).items() if count > 1}
-            print(second_filter_items, len(integer_list), len(set(integer_list)))
-            print(repeated_items)
-
-            # if len(integer_list) == len(set(integer_list)) and len(integer_list) > len(product_description_list)//2-2:
-            second_filter_relevant_context = [relevant_context[item_no] for item_no in integer_list]
-            
-            st.markdown(f"## **{'Output'}**", unsafe_allow_html=True)
-            display_images(second_filter_relevant_context)
-            break
-        except:
-            pass
+    st.markdown(f"## **{'Output'}**", unsafe_allow_html=True)
+
+    # Reruns, e.g. "Load more" clicks, reuse the results of this session
+    session_results = st.session_state.setdefault("variant_results", {})
+    if selected_image_path in session_results:
+        display_result_page(selected_image_path, session_results[selected_image_path])
+        return
+
+    status = st.empty()
+    placeholder = st.empty()
+    provisional = {}
+    streamed = []
+    visible = visible_result_count(selected_image_path)
+
+    def show_candidates(candidates, image_urls):
+        # Similarity order is shown right away and replaced once ranked results stream in
+        provisional["candidates"], provisional["image_urls"] = candidates, image_urls
+        status.caption("Ranking the results; showing them in similarity order meanwhile.")
+        display_images(candidates, image_urls, placeholder.container())
+
+    def show_result(context, image_url):
+        if not streamed:
+            status.empty()
+            provisional["grid"] = ResultGrid(placeholder.container())
+        if len(streamed) < visible:
+            provisional["grid"].add(context, image_url)
+        streamed.append(context)
+
+    try:
+        variants = find_variants(selected_image_path, product_info, display_width=RESULT_IMAGE_WIDTH,
+                                 on_candidates=show_candidates, on_result=show_result)
+    except EmbeddingError as e:
+        st.error(f"Could not generate the image embedding: {e}")
+        return
+    except openai.APIError as e:
+        if not provisional:
+            st.error(f"Could not rank the results: {e}")
+            return
+        status.warning(f"Could not rank the results ({e}); showing them in similarity order.")
+        display_images(provisional["candidates"], provisional["image_urls"], placeholder.container())
+        return
+    print(f"Find variants timings: {format_timings(variants.timings)}; images: {format_preprocess_stats()}")
+
+    if not variants.candidates:
+        status.info("No similar products were found.")
+        return
+
+    rerank_result = variants.rerank
+    print(f"Rerank returned {len(rerank_result.indices)}/{len(variants.candidates)} items in "
+          f"{rerank_result.latency_seconds:.2f}s (cached: {rerank_result.cached})")
+    if not rerank_result.indices:
+        status.warning("The results could not be ranked; showing them in similarity order.")
+    else:
+        status.empty()
+
+    # Redrawn with the final parse of the full reply, which wins over the incremental one
+    display_result_page(selected_image_path, variants.results, variants.image_urls, placeholder.container())
+    session_results[selected_image_path] = variants.results
+
+    try:
+        store_variants(selected_image_path, variants, get_current_index_version())
+    except Exception as e:
+        print(f"Could not store the results of {selected_image_path}: {e}")
+
+
+def show_stored_results(selected_image_path):
+    """
+    Shows the precomputed results of a query product, if any, and refreshes
+    them in the background when they are outdated.
+
+    :return: Whether stored results were shown.
+    """
+    stored = get_result_store().get(ResultStore.make_key(selected_image_path))
+    if stored is None:
+        return False
+
+    st.markdown(f"## **{'Output'}**", unsafe_allow_html=True)
+    visible = visible_result_count(selected_image_path)
+    # Only the visible page is signed
+    image_urls = get_stored_image_urls(stored.results[:visible], RESULT_IMAGE_WIDTH)
+    display_result_page(selected_image_path, stored.results, image_urls)
+    refresh_in_background(selected_image_path, mapped_data[selected_image_path])
+    return True
         
 def handle_action(action_name):
     clicked_image = next(img for img in images if img["action_name"] == action_name)
@@ -83,8 +188,8 @@ def handle_action(action_name):
     image_path = clicked_image["path"]
 
     # Display only the clicked image
-    image = Image.open(image_path)
-    st.image(image, width=300)
+    image_data, _ = encode_local_thumbnail(image_path, 2 * SELECTED_IMAGE_WIDTH)
+    st.image(image_data, width=SELECTED_IMAGE_WIDTH)
     caption = f"""
     **Brand**: {clicked_image["metadata"]["brand"]}  <br>
     **Flavour**: {clicked_image["metadata"]["flavour"]}  <br>
@@ -94,7 +199,8 @@ def handle_action(action_name):
     
     for image in images:
         if action_name == image["action_name"]:
-            on_click(image["path"])
+            if not show_stored_results(image["path"]):
+                on_click(image["path"])
 
 
 header_html = """
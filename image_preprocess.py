@@ -0,0 +1,144 @@
+import base64
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from PIL import Image, ImageOps
+from vars import VISION_IMAGE_MAX_SIDE, GPT_IMAGE_MAX_SIDE, GPT_IMAGE_SHORT_SIDE
+
+
+PREPROCESS_CACHE_SIZE = 128
+JPEG_QUALITY = 90
+
+# Formats sent as-is when no resize is needed, with their MIME types
+PASSTHROUGH_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+_preprocess_cache = OrderedDict()
+_preprocess_lock = threading.Lock()
+_preprocess_stats = {"images": 0, "original_bytes": 0, "sent_bytes": 0}
+
+
+@dataclass
+class PreparedImage:
+    """
+    An image ready to be uploaded to a vision API.
+
+    :param data: The encoded image bytes.
+    :param mime_type: The MIME type of `data`.
+    :param original_size: The size of the original image, in bytes.
+    """
+    data: bytes
+    mime_type: str
+    original_size: int
+
+    @property
+    def bytes_saved(self):
+        return self.original_size - len(self.data)
+
+    def to_base64(self):
+        return base64.b64encode(self.data).decode('utf-8')
+
+    def to_data_url(self):
+        return f"data:{self.mime_type};base64,{self.to_base64()}"
+
+
+def _target_size(width, height, max_side, short_side=None):
+    scale = min(1.0, max_side / max(width, height))
+    if short_side is not None:
+        scale = min(scale, short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _prepare(data, max_side, short_side):
+    image = Image.open(io.BytesIO(data))
+    source_format = image.format
+    original_size = image.size
+    target_size = _target_size(image.width, image.height, max_side, short_side)
+    orientation = image.getexif().get(0x0112, 1)
+
+    # Small, upright images in a supported format are sent untouched
+    if target_size == image.size and orientation == 1 and source_format in PASSTHROUGH_MIME_TYPES:
+        return PreparedImage(data, PASSTHROUGH_MIME_TYPES[source_format], len(data))
+
+    image.draft("RGB", target_size)
+    image = ImageOps.exif_transpose(image)
+    target_size = _target_size(image.width, image.height, max_side, short_side)
+    if target_size != image.size:
+        image = image.resize(target_size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    # Metadata is dropped by saving without exif/icc arguments
+    buffered = io.BytesIO()
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image.convert("RGBA").save(buffered, format="PNG", optimize=True)
+        mime_type = "image/png"
+    else:
+        image.convert("RGB").save(buffered, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+        mime_type = "image/jpeg"
+
+    prepared = PreparedImage(buffered.getvalue(), mime_type, len(data))
+    # The original is only a fallback when it was not resized, so it never exceeds the target size
+    if prepared.bytes_saved < 0 and target_size == original_size and source_format in PASSTHROUGH_MIME_TYPES \
+            and orientation == 1:
+        return PreparedImage(data, PASSTHROUGH_MIME_TYPES[source_format], len(data))
+    return prepared
+
+
+def preprocess_image(data: bytes, max_side: int, short_side: int = None):
+    """
+    Decodes an image once, downsizes it to what the target API actually uses,
+    applies the EXIF orientation, strips metadata and re-encodes it with the
+    matching MIME type. Results are cached by content hash and target size.
+
+    :param data: The original image bytes.
+    :param max_side: The maximum length of the longest side, in pixels.
+    :param short_side: The maximum length of the shortest side, in pixels.
+    :return: A PreparedImage.
+    """
+    cache_key = (hashlib.sha256(data).hexdigest(), max_side, short_side)
+    with _preprocess_lock:
+        prepared = _preprocess_cache.get(cache_key)
+        if prepared is not None:
+            _preprocess_cache.move_to_end(cache_key)
+            return prepared
+
+    prepared = _prepare(data, max_side, short_side)
+
+    with _preprocess_lock:
+        _preprocess_cache[cache_key] = prepared
+        while len(_preprocess_cache) > PREPROCESS_CACHE_SIZE:
+            _preprocess_cache.popitem(last=False)
+        _preprocess_stats["images"] += 1
+        _preprocess_stats["original_bytes"] += prepared.original_size
+        _preprocess_stats["sent_bytes"] += len(prepared.data)
+    return prepared
+
+
+def preprocess_for_vision(data: bytes):
+    """
+    Prepares an image for the Azure AI Vision Vectorize Image API.
+    """
+    return preprocess_image(data, VISION_IMAGE_MAX_SIDE)
+
+
+def preprocess_for_gpt(data: bytes):
+    """
+    Prepares an image for an Azure OpenAI vision model.
+    """
+    return preprocess_image(data, GPT_IMAGE_MAX_SIDE, GPT_IMAGE_SHORT_SIDE)
+
+
+def preprocess_stats():
+    """
+    Returns how many images were preprocessed and the bytes before and after.
+    """
+    with _preprocess_lock:
+        stats = dict(_preprocess_stats)
+    stats["bytes_saved"] = stats["original_bytes"] - stats["sent_bytes"]
+    return stats
+
+
+def format_preprocess_stats():
+    stats = preprocess_stats()
+    return (f"{stats['images']} images preprocessed, {stats['original_bytes']} -> {stats['sent_bytes']} bytes "
+            f"({stats['bytes_saved']} saved)")
@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from azure_blob_storage import create_container_if_not_exists, delete_all_blobs_from_folder, get_container_client, \
+    sanitize_blob_name, upload_files_to_blob_subfolder
+from azure_embeddings import vectorize_text
+from embedding_cache import format_embedding_cache_stats
+from gpt_gen import agenerate_item_description, close_async_openai_client
+from image_preprocess import format_preprocess_stats
+from manifest import IngestManifest
+from primary_images import get_primary_image_index
+from thumbnails import THUMBNAIL_PREFIX, parse_thumbnail_blob_name
+from utils import create_search_index_in_azure_ai_search, get_images_and_json, mark_index_changed, search_client
+from vars import BLOB_CONNECTION_STRING, CONTAINER_NAME, VISION_ENDPOINT, VISION_SUBSCRIPTION_KEY, VISION_VERSION
+
+
+def list_product_folders(catalog_path):
+    """
+    Lists the product folders (direct subfolders) of a local catalog folder.
+    """
+    return sorted(
+        os.path.join(catalog_path, name) for name in os.listdir(catalog_path)
+        if os.path.isdir(os.path.join(catalog_path, name)))
+
+
+def get_index_number(folder_name):
+    """
+    Derives a stable search document key from a product folder name.
+    """
+    return hashlib.sha1(folder_name.encode("utf-8")).hexdigest()
+
+
+def _yield_completed(submit, items, max_in_flight, stage_name):
+    """
+    Submits items with `submit`, which returns a concurrent.futures.Future,
+    keeping at most `max_in_flight` pending, and yields the results as they
+    complete. Items whose future raises are reported and dropped.
+    """
+    items = iter(items)
+    in_flight = {}
+    exhausted = False
+
+    while in_flight or not exhausted:
+        while not exhausted and len(in_flight) < max_in_flight:
+            try:
+                item = next(items)
+            except StopIteration:
+                exhausted = True
+                break
+            in_flight[submit(item)] = item
+
+        if not in_flight:
+            break
+
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            item = in_flight.pop(future)
+            try:
+                yield future.result()
+            except Exception as e:
+                print(f"Skipping {item['folder_name']}: {stage_name} failed: {e}")
+
+
+def bounded_map(function, items, max_workers, stage_name):
+    """
+    Applies `function` to each item on a pool of `max_workers` threads and
+    yields the results as they complete.
+
+    At most `2 * max_workers` items are in flight, so chaining several
+    bounded_map calls streams items through every stage concurrently without
+    materializing any stage's full output. Items for which `function` raises
+    are reported and dropped.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        yield from _yield_completed(lambda item: executor.submit(function, item), items, 2 * max_workers,
+                                    stage_name)
+
+
+def bounded_async_map(coroutine_function, items, max_concurrency, stage_name):
+    """
+    Coroutine counterpart of bounded_map: awaits `coroutine_function` for each
+    item on one event loop, with at most `max_concurrency` calls in flight, and
+    yields the results as they complete.
+
+    The loop runs on a background thread for the whole stage, so its async
+    OpenAI client and connection pool are shared by every call and closed
+    when the stage ends.
+    """
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, name=f"{stage_name}-loop", daemon=True)
+    thread.start()
+    try:
+        yield from _yield_completed(
+            lambda item: asyncio.run_coroutine_threadsafe(coroutine_function(item), loop), items,
+            max_concurrency, stage_name)
+    finally:
+        asyncio.run_coroutine_threadsafe(close_async_openai_client(), loop).result()
+        asyncio.run_coroutine_threadsafe(loop.shutdown_default_executor(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+def load_product(folder_path):
+    image_paths, json_list = get_images_and_json(folder_path)
+    if not image_paths:
+        raise ValueError("no images found")
+    if not json_list:
+        raise ValueError("no metadata JSON found")
+
+    return {
+        "folder_path": folder_path,
+        "folder_name": os.path.basename(folder_path),
+        "image_paths": sorted(image_paths),
+        "metadata": json_list[0],
+    }
+
+
+def load_products(folder_paths):
+    for folder_path in folder_paths:
+        try:
+            yield load_product(folder_path)
+        except Exception as e:
+            print(f"Skipping {os.path.basename(folder_path)}: {e}")
+
+
+async def adescribe_product(product):
+    product["description"] = await agenerate_item_description(
+        folder_path=product["folder_path"], image_paths=product["image_paths"])
+    return product
+
+
+def embed_product(product):
+    product["embedding"] = vectorize_text(
+        product["description"], VISION_ENDPOINT, VISION_SUBSCRIPTION_KEY, VISION_VERSION)
+    return product
+
+
+def upload_product(product, container_url):
+    blob_folder = sanitize_blob_name(product["folder_name"])
+    thumbnail_widths = {}
+    for image_path in product["image_paths"]:
+        thumbnail_widths.update(upload_files_to_blob_subfolder(
+            BLOB_CONNECTION_STRING, CONTAINER_NAME, '', image_path, blob_folder))
+    product["blob_names"] = list(thumbnail_widths)
+    product["blob_folder"] = blob_folder
+    product["product_folder_link"] = f"{container_url}/{blob_folder}"
+    # Only the thumbnails that were actually uploaded are recorded
+    primary_blob = min(product["blob_names"])
+    get_primary_image_index().set(CONTAINER_NAME, blob_folder, primary_blob, thumbnail_widths[primary_blob])
+    return product
+
+
+def to_search_document(product):
+    metadata = product["metadata"]
+    return {
+        "index_number": get_index_number(product["folder_name"]),
+        "category": metadata.get("category"),
+        "brand": metadata.get("brand"),
+        "flavour": metadata.get("flavour"),
+        "quantity": metadata.get("quantity"),
+        "product_folder_link": product["product_folder_link"],
+        "product_description": product["description"],
+        "product_description_vector": product["embedding"],
+    }
+
+
+def upsert_documents(documents):
+    """
+    Merges or uploads a batch of documents and returns the keys that failed.
+    """
+    results = search_client.merge_or_upload_documents(documents=documents)
+    failed = {result.key for result in results if not result.succeeded}
+    if failed:
+        print(f"Failed to index {len(failed)} documents: {sorted(failed)}")
+    return failed
+
+
+def ingest_products(folder_paths, describe_workers=8, embed_workers=16, upload_workers=8, batch_size=500,
+                    on_batch_indexed=None):
+    """
+    Streams product folders through the GPT description, text embedding and
+    blob upload stages and upserts the resulting documents in batches.
+
+    :param folder_paths: The local product folders to ingest.
+    :param describe_workers: Concurrent GPT description calls.
+    :param embed_workers: Concurrent Vision text embedding calls.
+    :param upload_workers: Concurrent blob uploads.
+    :param batch_size: Documents sent per merge_or_upload_documents call.
+    :param on_batch_indexed: Optional callback receiving the products of each batch that were indexed.
+    :return: The number of products indexed.
+    """
+    container_client = create_container_if_not_exists(BLOB_CONNECTION_STRING, CONTAINER_NAME)
+    container_url = container_client.url.rstrip('/')
+
+    products = load_products(folder_paths)
+    products = bounded_async_map(adescribe_product, products, describe_workers, "description")
+    products = bounded_map(embed_product, products, embed_workers, "embedding")
+    products = bounded_map(lambda product: upload_product(product, container_url), products,
+                           upload_workers, "upload")
+
+    start = time.perf_counter()
+    indexed = 0
+    batch = []
+
+    def flush():
+        nonlocal indexed, batch
+        failed = upsert_documents([to_search_document(product) for product in batch])
+        succeeded = [product for product in batch
+                     if get_index_number(product["folder_name"]) not in failed]
+        indexed += len(succeeded)
+        get_primary_image_index().save()
+        # Stored Find Variants results of earlier index versions are refreshed by the app
+        mark_index_changed()
+        if on_batch_indexed is not None:
+            on_batch_indexed(succeeded)
+        batch = []
+        elapsed = time.perf_counter() - start
+        print(f"Indexed {indexed} products in {elapsed:.1f}s ({indexed / max(elapsed, 1e-9):.2f} products/s)")
+
+    for product in products:
+        batch.append(product)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    return indexed
+
+
+def delete_product_blobs(blob_folder):
+    """
+    Deletes the images of a product folder and their thumbnails.
+    """
+    delete_all_blobs_from_folder(BLOB_CONNECTION_STRING, CONTAINER_NAME, f"{blob_folder}/")
+    delete_all_blobs_from_folder(BLOB_CONNECTION_STRING, CONTAINER_NAME, f"{THUMBNAIL_PREFIX}/{blob_folder}/")
+
+
+def delete_stale_product_blobs(blob_folder, blob_names):
+    """
+    Deletes the images of a product folder, and their thumbnails, that are not
+    among its current `blob_names`, e.g. images of a previous ingestion.
+    """
+    keep = set(blob_names)
+    container_client = get_container_client(BLOB_CONNECTION_STRING, CONTAINER_NAME)
+    for prefix in (f"{blob_folder}/", f"{THUMBNAIL_PREFIX}/{blob_folder}/"):
+        for blob in container_client.list_blobs(name_starts_with=prefix):
+            thumbnail = parse_thumbnail_blob_name(blob.name)
+            if (thumbnail[0] if thumbnail else blob.name) not in keep:
+                container_client.delete_blob(blob.name)
+
+
+def delete_products(removed, manifest, batch_size=500):
+    """
+    Deletes the search documents and blobs of products that were removed from
+    the catalog and drops them from the manifest.
+
+    :param removed: Manifest entries of the removed products, keyed by folder name.
+    :param manifest: The IngestManifest to update.
+    :param batch_size: Documents sent per delete_documents call.
+    """
+    folder_names = list(removed)
+    for i in range(0, len(folder_names), batch_size):
+        batch = folder_names[i:i + batch_size]
+        search_client.delete_documents(
+            documents=[{"index_number": removed[folder_name]["index_number"]} for folder_name in batch])
+
+        for folder_name in batch:
+            delete_product_blobs(removed[folder_name]["blob_folder"])
+            manifest.forget(folder_name)
+            get_primary_image_index().forget(CONTAINER_NAME, removed[folder_name]["blob_folder"])
+        manifest.save()
+        get_primary_image_index().save()
+        mark_index_changed()
+        print(f"Deleted {min(i + batch_size, len(folder_names))}/{len(folder_names)} removed products")
+
+
+def reindex_catalog(catalog_path, manifest_path, **ingest_options):
+    """
+    Re-indexes only the product folders that are new or changed since the
+    last run recorded in the manifest and deletes documents of removed ones.
+
+    The manifest is checkpointed after every indexed batch, so re-running after
+    a crash skips everything that was already indexed.
+
+    :param catalog_path: Folder containing one subfolder per product.
+    :param manifest_path: The JSON manifest file.
+    :param ingest_options: Worker and batch size options passed to ingest_products.
+    :return: The number of products indexed.
+    """
+    manifest = IngestManifest(manifest_path)
+    changed, removed = manifest.plan(list_product_folders(catalog_path))
+    print(f"{len(changed)} new or changed products, {len(removed)} removed products")
+
+    if removed:
+        delete_products(removed, manifest, ingest_options.get("batch_size", 500))
+
+    def checkpoint(products):
+        for product in products:
+            manifest.record(product["folder_name"], changed[product["folder_path"]],
+                            get_index_number(product["folder_name"]), product["blob_folder"])
+        manifest.save()
+
+        # Uploaded blob names are timestamped, so the images of a previous run stay
+        # behind; they are only deleted once the new document points at the new ones
+        for product in products:
+            try:
+                delete_stale_product_blobs(product["blob_folder"], product["blob_names"])
+            except Exception as e:
+                print(f"Could not delete stale blobs of {product['folder_name']}: {e}")
+
+    return ingest_products(list(changed), on_batch_indexed=checkpoint, **ingest_options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest a local product catalog into Azure AI Search.")
+    parser.add_argument("catalog_path", nargs="?", default="images",
+                        help="Folder containing one subfolder per product.")
+    parser.add_argument("--describe-workers", type=int, default=8)
+    parser.add_argument("--embed-workers", type=int, default=16)
+    parser.add_argument("--upload-workers", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--create-index", action="store_true",
+                        help="Create or update the search index before ingesting.")
+    parser.add_argument("--manifest",
+                        help="Manifest file enabling incremental, resumable re-indexing "
+                             "(e.g. .cache/ingest_manifest.json).")
+    args = parser.parse_args()
+
+    if args.create_index:
+        create_search_index_in_azure_ai_search()
+
+    start = time.perf_counter()
+    ingest_options = {
+        "describe_workers": args.describe_workers,
+        "embed_workers": args.embed_workers,
+        "upload_workers": args.upload_workers,
+        "batch_size": args.batch_size,
+    }
+    if args.manifest:
+        indexed = reindex_catalog(args.catalog_path, args.manifest, **ingest_options)
+    else:
+        indexed = ingest_products(list_product_folders(args.catalog_path), **ingest_options)
+    elapsed = time.perf_counter() - start
+    print(f"Done: {indexed} products in {elapsed:.1f}s ({indexed / max(elapsed, 1e-9):.2f} products/s)")
+    print(f"Images: {format_preprocess_stats()}")
+    print(f"Embeddings: {format_embedding_cache_stats()}")
+
+
+if __name__ == "__main__":
+    main()
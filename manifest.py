@@ -0,0 +1,95 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from utils import get_images_and_json
+
+
+def hash_product_folder(folder_path):
+    """
+    Hashes the image files and metadata JSON of a product folder.
+
+    :param folder_path: The local product folder.
+    :return: A hex digest that changes whenever an image or the metadata changes.
+    """
+    image_paths, json_list = get_images_and_json(folder_path)
+
+    digest = hashlib.sha256()
+    for image_path in sorted(image_paths):
+        digest.update(os.path.relpath(image_path, folder_path).encode("utf-8") + b"\0")
+        with open(image_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    digest.update(json.dumps(json_list, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class IngestManifest:
+    """
+    Records, per product folder, the content hash that was last indexed and
+    the resulting search document key, so re-index runs only touch products
+    that were added, changed or removed since the previous run.
+
+    The manifest is rewritten atomically after every indexed batch, which
+    makes an interrupted run resume where it stopped.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The JSON file the manifest is stored in.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.products = {}
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.products = json.load(f).get("products", {})
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self._lock:
+            content = {"products": self.products}
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, "w") as f:
+                json.dump(content, f, indent=2, sort_keys=True)
+            os.replace(temporary_path, self.path)
+
+    def plan(self, folder_paths):
+        """
+        Compares the product folders on disk with the manifest.
+
+        :param folder_paths: The local product folders currently in the catalog.
+        :return: A tuple of (folders to index with their content hashes,
+                 manifest entries of folders that were removed).
+        """
+        changed = {}
+        present = set()
+        for folder_path in folder_paths:
+            folder_name = os.path.basename(folder_path)
+            present.add(folder_name)
+            content_hash = hash_product_folder(folder_path)
+            entry = self.products.get(folder_name)
+            if entry is None or entry["hash"] != content_hash:
+                changed[folder_path] = content_hash
+
+        removed = {folder_name: entry for folder_name, entry in self.products.items()
+                   if folder_name not in present}
+        return changed, removed
+
+    def record(self, folder_name, content_hash, index_number, blob_folder):
+        with self._lock:
+            self.products[folder_name] = {
+                "hash": content_hash,
+                "index_number": index_number,
+                "blob_folder": blob_folder,
+                "indexed_at": datetime.now(timezone.utc).isoformat(),
+            }
+
+    def forget(self, folder_name):
+        with self._lock:
+            self.products.pop(folder_name, None)
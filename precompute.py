@@ -0,0 +1,175 @@
+import argparse
+import threading
+import time
+from azure_blob_storage import generate_sas_token, parse_blob_url
+from embedding_cache import format_embedding_cache_stats
+from find_variants import find_variants
+from gpt_gen import TOP_N_PROMPT_VERSION
+from image_data import images
+from image_preprocess import format_preprocess_stats
+from primary_images import get_primary_image_index
+from result_store import ResultStore, get_result_store
+from utils import get_index_version, get_search_backend
+from vars import BLOB_CONNECTION_STRING, RERANK_MODE, INDEX_VERSION_CHECK_SECONDS
+
+
+# Search result fields kept in the result store
+STORED_RESULT_FIELDS = ("index_number", "category", "brand", "flavour", "quantity", "product_folder_link")
+
+_index_version = None
+_index_version_checked_at = 0.0
+_index_version_lock = threading.Lock()
+
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def get_result_version(rerank_mode=RERANK_MODE):
+    """
+    Identifies the rerank prompt and mode results are computed with.
+    """
+    return f"{TOP_N_PROMPT_VERSION}/{rerank_mode}"
+
+
+def get_current_index_version(max_age_seconds=INDEX_VERSION_CHECK_SECONDS):
+    """
+    Returns the search index version, asking the service at most once every
+    `max_age_seconds`.
+    """
+    global _index_version, _index_version_checked_at
+    with _index_version_lock:
+        if _index_version is None or time.time() - _index_version_checked_at > max_age_seconds:
+            _index_version = get_index_version()
+            _index_version_checked_at = time.time()
+        return _index_version
+
+
+def materialize_results(results):
+    """
+    Converts ranked search results into SAS-independent stored results that
+    reference the primary image blob of every product.
+    """
+    primary_image_index = get_primary_image_index()
+    stored = []
+    for result in results:
+        entry = {name: result.get(name) for name in STORED_RESULT_FIELDS}
+        container_name, folder_name = parse_blob_url(result['product_folder_link'])
+        blob_name = primary_image_index.get(container_name, folder_name)
+        entry["image"] = {"container": container_name, "blob": blob_name} if blob_name else None
+        stored.append(entry)
+    return stored
+
+
+def get_stored_image_urls(results, display_width=None):
+    """
+    Signs the image references of stored results, choosing the thumbnail
+    that best fits `display_width`.
+    """
+    primary_image_index = get_primary_image_index()
+    image_urls = []
+    for result in results:
+        image = result.get("image")
+        if not image:
+            image_urls.append(None)
+            continue
+        display_blob = primary_image_index.get_display_blob(image["container"], image["blob"], display_width)
+        image_urls.append(generate_sas_token(BLOB_CONNECTION_STRING, image["container"], display_blob))
+    return image_urls
+
+
+def store_variants(image_path, variants, index_version):
+    """
+    Stores ranked Find Variants results; unranked fallbacks are not stored.
+
+    :return: Whether the results were stored.
+    """
+    if variants.rerank is None or not variants.rerank.indices:
+        return False
+    get_result_store().put(ResultStore.make_key(image_path), materialize_results(variants.results),
+                           index_version, get_result_version())
+    return True
+
+
+def precompute_query_results(query_images, force=False):
+    """
+    Runs the full Find Variants pipeline for every query product and stores
+    the final ordered results.
+
+    :param query_images: Entries of image_data.images.
+    :param force: Recompute results that are already current.
+    :return: The number of products whose results were stored.
+    """
+    store = get_result_store()
+    index_version = get_index_version()
+    result_version = get_result_version()
+    print(f"Index version {index_version}, result version {result_version}")
+
+    stored_count = 0
+    for image in query_images:
+        image_path = image["path"]
+        stored = store.get(ResultStore.make_key(image_path))
+        if not force and stored is not None and stored.is_current(index_version, result_version):
+            print(f"Up to date: {image_path}")
+            continue
+
+        try:
+            variants = find_variants(image_path, image["metadata"])
+        except Exception as e:
+            print(f"Skipping {image_path}: {e}")
+            continue
+
+        if store_variants(image_path, variants, index_version):
+            stored_count += 1
+            print(f"Stored {len(variants.results)} results for {image_path} "
+                  f"in {variants.timings['total']:.2f}s")
+        else:
+            print(f"Skipping {image_path}: the results could not be ranked")
+    return stored_count
+
+
+def _refresh(image_path, product_info):
+    try:
+        stored = get_result_store().get(ResultStore.make_key(image_path))
+        index_version = get_current_index_version()
+        if stored is not None and stored.is_current(index_version, get_result_version()):
+            return
+        print(f"Refreshing stored results for {image_path}")
+        store_variants(image_path, find_variants(image_path, product_info), index_version)
+    except Exception as e:
+        print(f"Could not refresh stored results for {image_path}: {e}")
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(image_path)
+
+
+def refresh_in_background(image_path, product_info):
+    """
+    Recomputes the stored results of a query product on a background thread
+    when the index or result version changed; a refresh already running for
+    the product is not started twice.
+    """
+    with _refreshing_lock:
+        if image_path in _refreshing:
+            return
+        _refreshing.add(image_path)
+    threading.Thread(target=_refresh, args=(image_path, product_info), daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Precompute Find Variants results for the catalog query products.")
+    parser.add_argument("--force", action="store_true", help="Recompute results that are already current.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stored_count = precompute_query_results(images, force=args.force)
+    print(f"Done: stored results for {stored_count}/{len(images)} products in "
+          f"{time.perf_counter() - start:.1f}s")
+    print(f"Images: {format_preprocess_stats()}")
+    print(f"Embeddings: {format_embedding_cache_stats()}")
+    for query_plan, stats in get_search_backend().stats().items():
+        print(f"Search plan '{query_plan}': {stats['queries']} queries, mean {stats['mean_ms']:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
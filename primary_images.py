@@ -0,0 +1,246 @@
+import json
+import os
+import threading
+from azure_blob_storage import get_container_client, generate_sas_token, image_extensions, parse_blob_url
+from thumbnails import THUMBNAIL_PREFIX, parse_thumbnail_blob_name, pick_thumbnail_width, thumbnail_blob_name
+from vars import PRIMARY_IMAGE_INDEX_PATH
+
+
+def _blob_folder(blob_name):
+    return blob_name.rsplit('/', 1)[0] if '/' in blob_name else ''
+
+
+def _is_preferred(blob_name, current):
+    """
+    Whether `blob_name` should replace `current` as the primary image of a
+    folder: images win over other files, then the lexicographically first name.
+    """
+    if current is None:
+        return True
+    blob_is_image = blob_name.lower().endswith(image_extensions)
+    current_is_image = current.lower().endswith(image_extensions)
+    if blob_is_image != current_is_image:
+        return blob_is_image
+    return blob_name < current
+
+
+class PrimaryImageIndex:
+    """
+    Persistent map from a product folder in Blob Storage to the blob name of
+    its primary image and the widths of its thumbnails, so result pages need
+    no per-result list_blobs call.
+
+    Other processes, e.g. the ingestion CLI, update the same file; see
+    reload_if_changed.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The JSON file the index is stored in.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.containers = {}
+        self.thumbnails = {}
+        self._file_stamp = None
+        # Folder changes not saved yet, re-applied over a reloaded file
+        self._unsaved = {}
+        self.reload_if_changed()
+
+    def _stat_file(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload_if_changed(self):
+        """
+        Reloads the index when its file was written since it was last loaded
+        or saved by this process.
+
+        :return: Whether the index was reloaded.
+        """
+        file_stamp = self._stat_file()
+        if file_stamp is None or file_stamp == self._file_stamp:
+            return False
+
+        with open(self.path, 'r') as f:
+            content = json.load(f)
+        with self._lock:
+            self.containers = content.get("containers", {})
+            self.thumbnails = content.get("thumbnails", {})
+            self._file_stamp = file_stamp
+            for (container_name, folder_name), entry in self._unsaved.items():
+                self._apply(container_name, folder_name, entry)
+        return True
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        with self._lock:
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, 'w') as f:
+                json.dump({"containers": self.containers, "thumbnails": self.thumbnails},
+                          f, indent=2, sort_keys=True)
+            os.replace(temporary_path, self.path)
+            self._file_stamp = self._stat_file()
+            self._unsaved = {}
+
+    def is_empty(self, container_name: str):
+        return not self.containers.get(container_name)
+
+    def rebuild(self, connection_string: str, container_name: str):
+        """
+        Rebuilds the index of a container from a single bulk blob listing.
+
+        :param connection_string: The connection string to the Azure Storage Account.
+        :param container_name: The name of the Azure Blob Storage container.
+        :return: The number of folders indexed.
+        """
+        folders = {}
+        thumbnails = {}
+        for blob in get_container_client(connection_string, container_name).list_blobs():
+            thumbnail = parse_thumbnail_blob_name(blob.name)
+            if thumbnail is not None:
+                thumbnails.setdefault(thumbnail[0], []).append(thumbnail[1])
+                continue
+
+            folder = _blob_folder(blob.name)
+            if _is_preferred(blob.name, folders.get(folder)):
+                folders[folder] = blob.name
+
+        primary_blobs = set(folders.values())
+        with self._lock:
+            self.containers[container_name] = folders
+            self.thumbnails[container_name] = {
+                blob_name: sorted(widths) for blob_name, widths in thumbnails.items() if blob_name in primary_blobs}
+        self.save()
+        return len(folders)
+
+    def _apply(self, container_name, folder_name, entry):
+        if entry is None:
+            blob_name = self.containers.get(container_name, {}).pop(folder_name, None)
+            self.thumbnails.get(container_name, {}).pop(blob_name, None)
+            return
+
+        blob_name, thumbnail_widths = entry
+        self.containers.setdefault(container_name, {})[folder_name] = blob_name
+        if thumbnail_widths:
+            self.thumbnails.setdefault(container_name, {})[blob_name] = thumbnail_widths
+        else:
+            self.thumbnails.get(container_name, {}).pop(blob_name, None)
+
+    def set(self, container_name: str, folder_name: str, blob_name: str, thumbnail_widths=None):
+        entry = (blob_name, sorted(thumbnail_widths or []))
+        with self._lock:
+            self._unsaved[(container_name, folder_name.strip('/'))] = entry
+            self._apply(container_name, folder_name.strip('/'), entry)
+
+    def forget(self, container_name: str, folder_name: str):
+        with self._lock:
+            self._unsaved[(container_name, folder_name.strip('/'))] = None
+            self._apply(container_name, folder_name.strip('/'), None)
+
+    def refresh_folder(self, connection_string: str, container_name: str, folder_name: str):
+        """
+        Lists a single folder and records its primary image.
+
+        :return: The primary image blob name, or None if the folder is empty.
+        """
+        folder_name = folder_name.strip('/')
+        container_client = get_container_client(connection_string, container_name)
+
+        primary = None
+        blobs = container_client.list_blobs(name_starts_with=f"{folder_name}/" if folder_name else None)
+        for blob in blobs:
+            if _blob_folder(blob.name) == folder_name and _is_preferred(blob.name, primary):
+                primary = blob.name
+
+        if primary is None:
+            return None
+
+        thumbnail_widths = []
+        for blob in container_client.list_blobs(name_starts_with=f"{THUMBNAIL_PREFIX}/{primary}.w"):
+            thumbnail = parse_thumbnail_blob_name(blob.name)
+            if thumbnail is not None and thumbnail[0] == primary:
+                thumbnail_widths.append(thumbnail[1])
+
+        self.set(container_name, folder_name, primary, thumbnail_widths)
+        return primary
+
+    def get(self, container_name: str, folder_name: str):
+        with self._lock:
+            return self.containers.get(container_name, {}).get(folder_name.strip('/'))
+
+    def get_display_blob(self, container_name: str, blob_name: str, display_width=None):
+        """
+        Returns the thumbnail blob that best fits `display_width`, or the
+        original blob when no width is given or it has no thumbnails.
+        """
+        if display_width is None:
+            return blob_name
+        with self._lock:
+            widths = self.thumbnails.get(container_name, {}).get(blob_name)
+        if not widths:
+            return blob_name
+        return thumbnail_blob_name(blob_name, pick_thumbnail_width(widths, display_width))
+
+    def get_sas_urls(self, connection_string: str, folder_links: list, display_width=None):
+        """
+        Returns the SAS URLs of the primary images of a page of results.
+
+        Folders missing from the index are listed once and added to it; every
+        other URL is signed locally without any network call.
+
+        :param connection_string: The connection string to the Azure Storage Account.
+        :param folder_links: The product_folder_link values of the results.
+        :param display_width: The width the images are shown at; selects a thumbnail when available.
+        :return: A list with a SAS URL (or None for an empty folder) per folder link.
+        """
+        sas_urls = []
+        refreshed = False
+        for folder_link in folder_links:
+            container_name, folder_name = parse_blob_url(folder_link)
+            blob_name = self.get(container_name, folder_name)
+            if blob_name is None:
+                blob_name = self.refresh_folder(connection_string, container_name, folder_name)
+                refreshed = refreshed or blob_name is not None
+
+            if blob_name is None:
+                sas_urls.append(None)
+                continue
+            display_blob = self.get_display_blob(container_name, blob_name, display_width)
+            sas_urls.append(generate_sas_token(connection_string, container_name, display_blob))
+
+        if refreshed:
+            self.save()
+        return sas_urls
+
+
+_primary_image_index = None
+_primary_image_index_lock = threading.Lock()
+
+
+def get_primary_image_index():
+    """
+    Returns the process-wide primary image index, reloaded when another
+    process such as a re-ingestion has written its file since.
+    """
+    global _primary_image_index
+    with _primary_image_index_lock:
+        if _primary_image_index is None:
+            _primary_image_index = PrimaryImageIndex(PRIMARY_IMAGE_INDEX_PATH)
+        else:
+            _primary_image_index.reload_if_changed()
+    return _primary_image_index
+
+
+def get_primary_image_sas_urls(connection_string: str, folder_links: list, display_width=None):
+    """
+    Returns the SAS URLs of the primary images (or their best-fitting
+    thumbnails) of the given product folders.
+    """
+    return get_primary_image_index().get_sas_urls(connection_string, folder_links, display_width)
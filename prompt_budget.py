@@ -0,0 +1,141 @@
+import math
+import re
+import time
+from dataclasses import dataclass, field
+from vars import RERANK_PROMPT_TOKEN_BUDGET, RERANK_DESCRIPTION_TOKENS, RERANK_MIN_CANDIDATES, RERANK_MAX_CANDIDATES
+
+
+# Rough size of the rerank instructions around the item list
+PROMPT_OVERHEAD_TOKENS = 250
+CHARACTERS_PER_TOKEN = 4
+# A score drop this many times larger than the median drop marks a natural cut-off
+SCORE_GAP_FACTOR = 3.0
+
+_sentence_end_pattern = re.compile(r"(?<=[.!?])\s+")
+
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens of a text (about four characters per token).
+    """
+    return math.ceil(len(text or "") / CHARACTERS_PER_TOKEN)
+
+
+def truncate_description(description, max_tokens):
+    """
+    Truncates a product description to about `max_tokens` tokens, cutting at a
+    sentence boundary when possible. The opening sentences of the generated
+    descriptions carry the product name, flavour and size.
+    """
+    description = " ".join((description or "").split())
+    max_characters = max_tokens * CHARACTERS_PER_TOKEN
+    if len(description) <= max_characters:
+        return description
+
+    truncated = ""
+    for sentence in _sentence_end_pattern.split(description):
+        if len(truncated) + len(sentence) + 1 > max_characters:
+            break
+        truncated = f"{truncated} {sentence}".strip()
+    return truncated or description[:max_characters].rstrip() + "..."
+
+
+def format_budgeted_candidate(result, max_description_tokens):
+    """
+    Formats a search result for the rerank prompt with its discriminative
+    fields first and a truncated description.
+    """
+    return (f"Brand: {result.get('brand')}\n Flavour: {result.get('flavour')}\n Quantity: {result.get('quantity')}\n"
+            f"Product Description: {truncate_description(result.get('product_description'), max_description_tokens)}")
+
+
+def score_cutoff(scores, min_candidates, max_candidates):
+    """
+    Chooses how many of the score-ordered candidates to keep: the cut is placed
+    at the largest score drop within the first `max_candidates` when that drop
+    clearly stands out from the others, and otherwise at `max_candidates`.
+
+    :return: A tuple of (number of candidates to keep, reason).
+    """
+    limit = min(len(scores), max_candidates)
+    if limit <= min_candidates:
+        return limit, "all candidates"
+
+    gaps = [scores[i] - scores[i + 1] for i in range(limit - 1)]
+    median_gap = sorted(gaps)[len(gaps) // 2]
+    position = max(range(min_candidates - 1, len(gaps)), key=lambda i: gaps[i])
+    if gaps[position] > 0 and gaps[position] > SCORE_GAP_FACTOR * median_gap:
+        return position + 1, f"score gap of {gaps[position]:.4f} after candidate {position + 1}"
+    return limit, "max candidates"
+
+
+@dataclass
+class CandidateBudget:
+    """
+    Candidates selected for the rerank prompt.
+
+    :param positions: Positions of the selected candidates in the search results.
+    :param items: The formatted item texts, in the same order.
+    :param prompt_tokens: Estimated prompt tokens, including the instructions.
+    :param reason: Why the list was cut where it was.
+    """
+    positions: list = field(default_factory=list)
+    items: list = field(default_factory=list)
+    prompt_tokens: int = PROMPT_OVERHEAD_TOKENS
+    reason: str = ""
+
+
+def budget_candidates(candidates, token_budget=RERANK_PROMPT_TOKEN_BUDGET,
+                      max_description_tokens=RERANK_DESCRIPTION_TOKENS,
+                      min_candidates=RERANK_MIN_CANDIDATES, max_candidates=RERANK_MAX_CANDIDATES,
+                      fetch_descriptions=None, score_ordered=True):
+    """
+    Selects and formats the candidates that are sent to the multimodal rerank.
+
+    The number of candidates adapts to the search score distribution and is
+    then capped so that the estimated prompt stays within `token_budget`.
+    Candidates in any other order, e.g. a local rerank order, are only capped
+    at `max_candidates` and by the token budget, as their score gaps carry no
+    cut-off.
+
+    :param candidates: The search results, in search order.
+    :param token_budget: The maximum estimated prompt tokens.
+    :param max_description_tokens: The maximum tokens of each truncated description.
+    :param min_candidates: Candidates kept regardless of the score distribution.
+    :param max_candidates: The maximum number of candidates sent.
+    :param fetch_descriptions: Optional batched lookup from index_number to
+        description, used for kept candidates returned without one.
+    :param score_ordered: Whether `candidates` are in descending search score order.
+    :return: A CandidateBudget.
+    """
+    if score_ordered:
+        scores = [result.get("@search.score") or 0.0 for result in candidates]
+        keep, reason = score_cutoff(scores, min_candidates, max_candidates)
+    else:
+        keep, reason = min(len(candidates), max_candidates), "max candidates"
+    kept = candidates[:keep]
+
+    missing = [result["index_number"] for result in kept if result.get("product_description") is None]
+    if missing and fetch_descriptions is not None:
+        start = time.perf_counter()
+        descriptions = fetch_descriptions(missing)
+        kept = [result if result.get("product_description") is not None
+                else {**result, "product_description": descriptions.get(result["index_number"])}
+                for result in kept]
+        print(f"Fetched {len(descriptions)}/{len(missing)} descriptions in "
+              f"{(time.perf_counter() - start) * 1000:.0f}ms")
+
+    budget = CandidateBudget(reason=reason)
+    for position, result in enumerate(kept):
+        item = format_budgeted_candidate(result, max_description_tokens)
+        item_tokens = estimate_tokens(f"ITEM {position + 1}: {item}\n\n")
+        if budget.items and budget.prompt_tokens + item_tokens > token_budget:
+            budget.reason = f"token budget of {token_budget}"
+            break
+        budget.positions.append(position)
+        budget.items.append(item)
+        budget.prompt_tokens += item_tokens
+
+    print(f"Rerank prompt: {len(budget.items)}/{len(candidates)} candidates, "
+          f"~{budget.prompt_tokens} tokens, cut-off: {budget.reason}")
+    return budget
@@ -0,0 +1,157 @@
+import re
+import time
+import numpy as np
+from gpt_gen import RerankResult, generate_top_n_search_results
+from prompt_budget import budget_candidates
+from utils import get_search_backend
+from vars import RERANK_MODE, RERANK_TOP_K
+
+
+# Weights of the local relevance score components; category only counts with a category classifier
+LOCAL_SCORE_WEIGHTS = {
+    "search_score": 0.5,
+    "flavour": 0.3,
+    "quantity": 0.15,
+    "category": 0.05,
+}
+
+_token_pattern = re.compile(r"[a-z0-9]+")
+_number_pattern = re.compile(r"\d+(?:\.\d+)?")
+
+
+def _tokens(text):
+    return set(_token_pattern.findall((text or "").lower()))
+
+
+def parse_quantity(quantity):
+    """
+    Parses the first number out of a quantity string such as "15 Oz" or "14.5".
+
+    :return: The quantity as a float, or NaN if it holds no number.
+    """
+    match = _number_pattern.search(str(quantity or ""))
+    return float(match.group()) if match else float("nan")
+
+
+def local_scores(candidates, query_metadata, category_classifier=None):
+    """
+    Scores candidates against the query product without any model call.
+
+    The score combines the min-max normalized search score, flavour token
+    overlap (Jaccard), closeness of the numeric quantity on a log scale and,
+    given a classifier, a category probability.
+
+    :param candidates: The search results, in search order.
+    :param query_metadata: The query product's category, flavour and quantity.
+    :param category_classifier: Optional callable returning, for every
+        candidate, the probability that it is in the query's category.
+        Without one the category is not scored: the search already filters
+        on it, so every candidate would score the same.
+    :return: A NumPy array with one score per candidate.
+    """
+    search_scores = np.array([result.get("@search.score") or 0.0 for result in candidates], dtype=np.float64)
+    score_range = np.ptp(search_scores)
+    search_scores = (search_scores - search_scores.min()) / score_range if score_range > 0 \
+        else np.ones_like(search_scores)
+
+    query_flavour = _tokens(query_metadata.get("flavour"))
+    flavour_scores = np.array([
+        len(query_flavour & tokens) / len(query_flavour | tokens) if query_flavour | tokens else 0.0
+        for tokens in (_tokens(result.get("flavour")) for result in candidates)
+    ])
+
+    query_quantity = parse_quantity(query_metadata.get("quantity"))
+    quantities = np.array([parse_quantity(result.get("quantity")) for result in candidates])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        quantity_scores = np.exp(-np.abs(np.log(quantities) - np.log(query_quantity)))
+    quantity_scores = np.nan_to_num(quantity_scores, nan=0.0)
+
+    scores = (LOCAL_SCORE_WEIGHTS["search_score"] * search_scores
+              + LOCAL_SCORE_WEIGHTS["flavour"] * flavour_scores
+              + LOCAL_SCORE_WEIGHTS["quantity"] * quantity_scores)
+    if category_classifier is not None:
+        category_scores = np.asarray(category_classifier(query_metadata, candidates), dtype=np.float64)
+        scores = scores + LOCAL_SCORE_WEIGHTS["category"] * category_scores
+    return scores
+
+
+def _emit_all(indices, on_index):
+    if on_index is not None:
+        for index in indices:
+            on_index(index)
+
+
+def gpt_rerank(candidates, image_path, query_metadata, on_index=None, score_ordered=True, **options):
+    """
+    Reranks the candidates that fit the prompt token budget with the
+    multimodal model; candidates cut by the budget are left out.
+
+    :param score_ordered: Whether `candidates` are in search score order,
+        which allows cutting them at a search score gap.
+    """
+    budget = budget_candidates(candidates, fetch_descriptions=get_search_backend().get_descriptions,
+                               score_ordered=score_ordered)
+    result = generate_top_n_search_results(
+        budget.items, image_path,
+        candidate_ids=[candidates[position]["index_number"] for position in budget.positions],
+        on_index=None if on_index is None else lambda i: on_index(budget.positions[i]))
+    result.indices = [budget.positions[i] for i in result.indices]
+    return result
+
+
+def local_rerank(candidates, image_path, query_metadata, category_classifier=None, on_index=None, **options):
+    start = time.perf_counter()
+    scores = local_scores(candidates, query_metadata, category_classifier)
+    # Stable sort keeps search order between equally scored candidates
+    indices = np.argsort(-scores, kind="stable").tolist()
+    _emit_all(indices, on_index)
+    return RerankResult(indices, "", time.perf_counter() - start)
+
+
+def local_then_gpt_rerank(candidates, image_path, query_metadata, top_k=RERANK_TOP_K, category_classifier=None,
+                          on_index=None, **options):
+    """
+    Orders all candidates locally, then lets the multimodal model rerank only
+    the local top `top_k`; the remaining candidates keep their local order.
+    Head candidates the model did not rank, e.g. those cut by the prompt
+    budget, follow the ranked ones ahead of the rest.
+    """
+    start = time.perf_counter()
+    local_order = local_rerank(candidates, image_path, query_metadata, category_classifier).indices
+    head, tail = local_order[:top_k], local_order[top_k:]
+
+    # The head is in local order, so its search score gaps mean nothing
+    gpt_result = gpt_rerank([candidates[i] for i in head], image_path, query_metadata,
+                            on_index=None if on_index is None else lambda i: on_index(head[i]),
+                            score_ordered=False)
+    ranked = [head[i] for i in gpt_result.indices]
+    ranked_set = set(ranked)
+    rest = [i for i in head if i not in ranked_set] + tail
+    indices = ranked + rest
+    _emit_all(rest, on_index)
+    return RerankResult(indices, gpt_result.reply, time.perf_counter() - start, gpt_result.cached)
+
+
+RERANKERS = {
+    "gpt": gpt_rerank,
+    "local": local_rerank,
+    "local-then-gpt": local_then_gpt_rerank,
+}
+
+
+def rerank_candidates(candidates, image_path, query_metadata, mode=RERANK_MODE, **options):
+    """
+    Reranks search results with the configured rerank stage.
+
+    :param candidates: The search results, in search order.
+    :param image_path: The query image filepath.
+    :param query_metadata: The query product's metadata.
+    :param mode: "gpt", "local" or "local-then-gpt".
+    :param options: Stage options, e.g. top_k, category_classifier, score_ordered
+        (whether search score gaps may cut the GPT candidates) or on_index, a
+        callback receiving each ranked position as soon as it is known.
+    :return: A RerankResult with zero-based positions into `candidates`.
+    """
+    if mode not in RERANKERS:
+        raise ValueError(f"Unknown rerank mode '{mode}'. Expected one of {sorted(RERANKERS)}.")
+    return RERANKERS[mode](candidates, image_path, query_metadata, **options)
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from vars import RERANK_CACHE_PATH, RERANK_CACHE_TTL_SECONDS
+
+
+class RerankCache:
+    """
+    Persistent cache of multimodal rerank replies.
+
+    Entries are keyed by the query image content, the ordered candidate keys
+    and texts, the prompt version and the model deployment, so any change to
+    an indexed candidate produces a new key. Entries expire after `ttl_seconds`.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float):
+        """
+        :param path: The SQLite database file to store the replies in.
+        :param ttl_seconds: How long a reply stays valid.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS reranks ("
+            "key TEXT PRIMARY KEY, reply TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(image_bytes: bytes, candidate_ids, candidate_texts, prompt_version: str, deployment: str):
+        """
+        Builds the cache key for a rerank request.
+
+        :param image_bytes: The query image.
+        :param candidate_ids: The ordered index_number values of the candidates, if known.
+        :param candidate_texts: The ordered candidate texts sent to the model.
+        :param prompt_version: The version of the rerank prompt.
+        :param deployment: The Azure OpenAI deployment name.
+        :return: A hex digest identifying the request.
+        """
+        digest = hashlib.sha256()
+        digest.update(hashlib.sha256(image_bytes).digest())
+        digest.update(json.dumps([list(candidate_ids or []), list(candidate_texts),
+                                  prompt_version, deployment]).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        Returns the cached reply for `key`, or None on a miss or an expired entry.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT reply, created_at FROM reranks WHERE key = ?", (key,)).fetchone()
+            if row is not None and time.time() - row[1] > self.ttl_seconds:
+                self._connection.execute("DELETE FROM reranks WHERE key = ?", (key,))
+                self._connection.commit()
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, reply: str):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO reranks (key, reply, created_at) VALUES (?, ?, ?)",
+                (key, reply, time.time()))
+            self._connection.execute(
+                "DELETE FROM reranks WHERE created_at < ?", (time.time() - self.ttl_seconds,))
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM reranks")
+            self._connection.commit()
+
+
+_rerank_cache = None
+_rerank_cache_lock = threading.Lock()
+
+
+def get_rerank_cache():
+    """
+    Returns the process-wide rerank cache.
+    """
+    global _rerank_cache
+    with _rerank_cache_lock:
+        if _rerank_cache is None:
+            _rerank_cache = RerankCache(RERANK_CACHE_PATH, RERANK_CACHE_TTL_SECONDS)
+    return _rerank_cache
@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from vars import RESULT_STORE_PATH
+
+
+@dataclass
+class StoredResults:
+    """
+    Materialized Find Variants results of one query image.
+
+    :param results: The ordered results; each holds the display metadata and an
+        "image" reference ({"container", "blob"}) that is signed when served.
+    :param index_version: The search index version the results were computed against.
+    :param result_version: The rerank prompt and mode the results were computed with.
+    :param created_at: When the results were computed, as a UNIX timestamp.
+    """
+    results: list = field(default_factory=list)
+    index_version: str = ""
+    result_version: str = ""
+    created_at: float = 0.0
+
+    def is_current(self, index_version, result_version):
+        return self.index_version == index_version and self.result_version == result_version
+
+
+class ResultStore:
+    """
+    Persistent store of precomputed Find Variants results, keyed by the
+    content of the query image.
+
+    Results hold blob references instead of SAS URLs, so stored entries never
+    expire with their signatures; staleness is decided by comparing the index
+    and result versions they were computed with.
+    """
+
+    def __init__(self, path: str):
+        """
+        :param path: The SQLite database file to store the results in.
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, results TEXT NOT NULL, index_version TEXT NOT NULL, "
+            "result_version TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(image_path: str):
+        """
+        Builds the store key of a query image from its content.
+        """
+        with open(image_path, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    def get(self, key: str):
+        """
+        Returns the StoredResults for `key`, or None if nothing is stored.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT results, index_version, result_version, created_at FROM results WHERE key = ?",
+                (key,)).fetchone()
+        if row is None:
+            return None
+        return StoredResults(json.loads(row[0]), row[1], row[2], row[3])
+
+    def put(self, key: str, results, index_version: str, result_version: str):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results (key, results, index_version, result_version, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(results), index_version, result_version, time.time()))
+            self._connection.commit()
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM results")
+            self._connection.commit()
+
+
+_result_store = None
+_result_store_lock = threading.Lock()
+
+
+def get_result_store():
+    """
+    Returns the process-wide result store.
+    """
+    global _result_store
+    with _result_store_lock:
+        if _result_store is None:
+            _result_store = ResultStore(RESULT_STORE_PATH)
+    return _result_store
@@ -0,0 +1,500 @@
+import json
+import math
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from azure.search.documents.models import QueryAnswerType, QueryCaptionType, QueryType, VectorizedQuery
+
+
+VECTOR_FIELD = "product_description_vector"
+# Fields with posting lists in the local index, i.e. the fields search filters use
+FILTERABLE_FIELDS = ("category", "brand")
+RESULT_FIELDS = ["index_number", "product_folder_link", "product_description",
+                 "category", "brand", "flavour", "quantity"]
+# Short fields returned by similarity searches; descriptions are fetched later with get_descriptions
+DISPLAY_FIELDS = [name for name in RESULT_FIELDS if name != "product_description"]
+
+VECTORS_FILE = "vectors.f32"
+DOCUMENTS_FILE = "documents.json"
+IVF_FILE = "ivf.npz"
+
+# Query plans: which of full-text search, the semantic ranker and extractive
+# captions/answers are added to the vector query, and whether the gaps between
+# consecutive scores reflect similarity (vector scores) rather than rank fusion
+# or a relevance grade
+QUERY_PLANS = {
+    "vector": {"text": False, "semantic": False, "captions": False, "similarity_scores": True},
+    "hybrid": {"text": True, "semantic": False, "captions": False, "similarity_scores": False},
+    "semantic": {"text": True, "semantic": True, "captions": False, "similarity_scores": False},
+    "semantic-captions": {"text": True, "semantic": True, "captions": True, "similarity_scores": False},
+}
+
+
+def cosine_search_score(similarities):
+    """
+    Maps cosine similarities to the @search.score Azure AI Search reports for
+    cosine vector queries, so both backends rank and score alike.
+    """
+    return 1.0 / (2.0 - similarities)
+
+
+# Shared by all PagedSearchResults; each of them fetches at most one remainder in the background
+_prefetch_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="search-prefetch")
+
+
+class PagedSearchResults:
+    """
+    Search results whose first page is fetched on its own.
+
+    The first page and all the remaining results are fetched concurrently, the
+    remainder in one background request, so the caller can render the first
+    page while the rest arrives. Later pages are served from that request. Iterating yields
+    every result.
+    """
+
+    def __init__(self, fetch, page_size, top):
+        """
+        :param fetch: Callable returning `count` results after skipping `skip`, called as fetch(skip, count).
+        :param page_size: The number of results per page.
+        :param top: The total number of results over all pages.
+        """
+        self.page_size = page_size
+        self.top = top
+        self.results = []
+        self._fetch = fetch
+        self._remainder = None
+        self._buffer = None
+        self._exhausted = page_size <= 0 or top <= 0
+
+    @property
+    def has_more(self):
+        return not self._exhausted
+
+    def next_page(self):
+        """
+        Returns the next page of results, or an empty list when there are no more.
+        """
+        if not self.has_more:
+            return []
+
+        if self._buffer is None and self._remainder is None:
+            if self.top > self.page_size:
+                self._remainder = _prefetch_executor.submit(self._fetch, self.page_size, self.top - self.page_size)
+            page = self._fetch(0, min(self.page_size, self.top))
+            if len(page) < self.page_size or self._remainder is None:
+                self._exhausted = True
+                if self._remainder is not None:
+                    self._remainder.cancel()
+                    self._remainder = None
+        else:
+            if self._remainder is not None:
+                self._buffer = self._remainder.result()
+                self._remainder = None
+            page, self._buffer = self._buffer[:self.page_size], self._buffer[self.page_size:]
+            if not self._buffer:
+                self._exhausted = True
+
+        self.results.extend(page)
+        return page
+
+    def fetch_all(self):
+        """
+        Fetches the remaining results and returns all of them.
+        """
+        while self.has_more:
+            self.next_page()
+        return self.results
+
+    def __iter__(self):
+        position = 0
+        while True:
+            while position < len(self.results):
+                yield self.results[position]
+                position += 1
+            if not self.has_more:
+                return
+            self.next_page()
+
+
+def build_query_text(metadata):
+    """
+    Builds the full-text query of hybrid and semantic plans from product metadata.
+    """
+    return " ".join(str(metadata[name]) for name in ("brand", "flavour", "category") if metadata.get(name))
+
+
+def validate_query_plan(query_plan):
+    if query_plan not in QUERY_PLANS:
+        raise ValueError(f"Unknown query plan '{query_plan}'. Expected one of {list(QUERY_PLANS)}.")
+
+
+class SearchBackend(ABC):
+    """
+    Interface of the product vector search.
+    """
+
+    @abstractmethod
+    def search(self, vector, filters=None, top=100, select=None, query_plan="vector", query_text=None):
+        """
+        Returns the `top` documents closest to `vector`.
+
+        :param vector: The query embedding.
+        :param filters: Exact-match field filters, e.g. {"category": ..., "brand": ...}.
+        :param top: The number of results.
+        :param select: The fields to return; defaults to RESULT_FIELDS.
+        :param query_plan: One of QUERY_PLANS.
+        :param query_text: The full-text query of plans that use one.
+        :return: A list of result dicts with an "@search.score", best first.
+            With the "vector" plan it is the cosine similarity score; with
+            "hybrid" the reciprocal rank fusion score of the text and vector
+            ranks; with the semantic plans the semantic ranker score (0 to 4),
+            which also orders the results.
+        """
+
+    def search_pages(self, vector, filters=None, top=100, page_size=20, select=None, query_plan="vector",
+                     query_text=None):
+        """
+        Lazily pages through the `top` documents closest to `vector`; see search.
+
+        This default runs one search for the first page and slices it.
+
+        :param page_size: The number of results per page.
+        :return: PagedSearchResults.
+        """
+        results = None
+
+        def fetch(skip, count):
+            nonlocal results
+            if results is None:
+                results = self.search(vector, filters, top, select, query_plan, query_text)
+            return results[skip:skip + count]
+
+        return PagedSearchResults(fetch, page_size, top)
+
+    def stats(self):
+        """
+        Returns the number of queries and their mean latency per query plan.
+
+        :return: A dict from query plan to {"queries": ..., "mean_ms": ...};
+            empty for backends that do not time their queries.
+        """
+        return {}
+
+    @abstractmethod
+    def get_descriptions(self, keys):
+        """
+        Looks up the product descriptions of documents in one batch.
+
+        :param keys: The index_number values of the documents.
+        :return: A dict from index_number to product description.
+        """
+
+
+def odata_filter(filters):
+    """
+    Builds an OData filter expression from exact-match field filters.
+    """
+    if not filters:
+        return None
+    # Single quotes are escaped by doubling them in OData string literals
+    return " and ".join(f"{name} eq '{str(value).replace(chr(39), chr(39) * 2)}'"
+                        for name, value in filters.items())
+
+
+class AzureSearchBackend(SearchBackend):
+    """
+    Vector search on the Azure AI Search product index.
+
+    Every query plan is timed; see stats.
+    """
+
+    def __init__(self, search_client):
+        """
+        :param search_client: The SearchClient of the product index.
+        """
+        self.search_client = search_client
+        self.plan_stats = {}
+        self._lock = threading.Lock()
+
+    def _record(self, query_plan, seconds):
+        with self._lock:
+            stats = self.plan_stats.setdefault(query_plan, {"queries": 0, "total_seconds": 0.0})
+            stats["queries"] += 1
+            stats["total_seconds"] += seconds
+
+    def stats(self):
+        with self._lock:
+            return {query_plan: {"queries": stats["queries"],
+                                 "mean_ms": stats["total_seconds"] / stats["queries"] * 1000}
+                    for query_plan, stats in self.plan_stats.items()}
+
+    def search(self, vector, filters=None, top=100, select=None, query_plan="vector", query_text=None):
+        return self._query(vector, filters, top, top, 0, select, query_plan, query_text)
+
+    def search_pages(self, vector, filters=None, top=100, page_size=20, select=None, query_plan="vector",
+                     query_text=None):
+        # The semantic ranker reorders the window of each request, so two windows would not
+        # form one ranking; those plans run as one request that is sliced
+        if QUERY_PLANS.get(query_plan, {}).get("semantic"):
+            return super().search_pages(vector, filters, top, page_size, select, query_plan, query_text)
+
+        # Two requests: the first page, then the remainder, both slices (skip/top) of the same `top` neighbors
+        def fetch(skip, count):
+            return self._query(vector, filters, top, count, skip, select, query_plan, query_text)
+
+        return PagedSearchResults(fetch, page_size, top)
+
+    def _query(self, vector, filters, k, top, skip, select, query_plan, query_text):
+        validate_query_plan(query_plan)
+        plan = QUERY_PLANS[query_plan]
+        vector_query = VectorizedQuery(vector=vector, k_nearest_neighbors=k, fields=VECTOR_FIELD)
+
+        options = {}
+        if plan["text"]:
+            if not query_text:
+                raise ValueError(f"The '{query_plan}' query plan needs a query text.")
+            options["search_text"] = query_text
+        if plan["semantic"]:
+            options["query_type"] = QueryType.SEMANTIC
+            options["semantic_configuration_name"] = 'my-semantic-config'
+        if plan["captions"]:
+            options["query_caption"] = QueryCaptionType.EXTRACTIVE
+            options["query_answer"] = QueryAnswerType.EXTRACTIVE
+
+        start = time.perf_counter()
+        results = self.search_client.search(
+            vector_queries=[vector_query],
+            select=select or RESULT_FIELDS,
+            filter=odata_filter(filters),
+            top=top,
+            skip=skip or None,
+            **options
+        )
+        results = list(results)
+        if plan["semantic"]:
+            # Semantic results are ordered by the ranker score, which replaces the fused score downstream
+            for result in results:
+                if result.get("@search.reranker_score") is not None:
+                    result["@search.score"] = result["@search.reranker_score"]
+        self._record(query_plan, time.perf_counter() - start)
+        return results
+
+    def get_descriptions(self, keys):
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        # Keys are hex digests, so a comma is a safe search.in delimiter
+        results = self.search_client.search(
+            filter=f"search.in(index_number, '{','.join(keys)}', ',')",
+            select=["index_number", "product_description"],
+            top=len(keys)
+        )
+        return {result["index_number"]: result["product_description"] for result in results}
+
+
+def _normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def build_ivf(vectors, lists, iterations=10, sample_size=None, seed=0):
+    """
+    Clusters normalized vectors with spherical k-means for an inverted file
+    (IVF) index.
+
+    :param vectors: The normalized vectors, one per row.
+    :param lists: The number of clusters (inverted lists).
+    :param iterations: The number of k-means iterations.
+    :param sample_size: Rows the centroids are trained on; defaults to 256 per list.
+    :param seed: Seed of the initial centroid choice and the training sample.
+    :return: A tuple of (centroids, list assignment per row).
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), sample_size or 256 * lists)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+    centroids = sample[rng.choice(len(sample), lists, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        for cluster in range(lists):
+            members = sample[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+        centroids = _normalize_rows(centroids)
+
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), 65536):
+        assignments[start:start + 65536] = np.argmax(vectors[start:start + 65536] @ centroids.T, axis=1)
+    return centroids.astype(np.float32), assignments
+
+
+def write_local_index(directory, documents, ivf_min_documents=None):
+    """
+    Writes documents to a local vector index directory.
+
+    Vectors are normalized and appended to a raw float32 file that is later
+    memory-mapped; the remaining fields go to a JSON file. An IVF index is
+    built when the index holds at least `ivf_min_documents` documents.
+
+    :param directory: The local index directory.
+    :param documents: Search documents, each with a VECTOR_FIELD.
+    :param ivf_min_documents: Minimum size of the index that gets an IVF index; None disables it.
+    :return: The number of documents written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    stored_documents = []
+    dimensions = None
+
+    with open(os.path.join(directory, f"{VECTORS_FILE}.tmp"), "wb") as f:
+        for document in documents:
+            vector = np.asarray(document[VECTOR_FIELD], dtype=np.float32)
+            if dimensions is None:
+                dimensions = len(vector)
+            elif len(vector) != dimensions:
+                raise ValueError(f"Document {document.get('index_number')} has {len(vector)} dimensions, "
+                                 f"expected {dimensions}.")
+            (vector / max(float(np.linalg.norm(vector)), 1e-12)).astype(np.float32).tofile(f)
+            stored_documents.append({name: value for name, value in document.items()
+                                     if name != VECTOR_FIELD and not name.startswith("@")})
+
+    with open(os.path.join(directory, f"{DOCUMENTS_FILE}.tmp"), "w") as f:
+        json.dump({"dimensions": dimensions or 0, "documents": stored_documents}, f)
+
+    ivf_path = os.path.join(directory, IVF_FILE)
+    if ivf_min_documents is not None and len(stored_documents) >= ivf_min_documents:
+        vectors = np.fromfile(os.path.join(directory, f"{VECTORS_FILE}.tmp"), dtype=np.float32)
+        centroids, assignments = build_ivf(vectors.reshape(-1, dimensions), int(np.sqrt(len(stored_documents))))
+        with open(f"{ivf_path}.tmp", "wb") as f:
+            np.savez(f, centroids=centroids, assignments=assignments)
+        os.replace(f"{ivf_path}.tmp", ivf_path)
+    elif os.path.exists(ivf_path):
+        os.remove(ivf_path)
+
+    os.replace(os.path.join(directory, f"{VECTORS_FILE}.tmp"), os.path.join(directory, VECTORS_FILE))
+    os.replace(os.path.join(directory, f"{DOCUMENTS_FILE}.tmp"), os.path.join(directory, DOCUMENTS_FILE))
+    return len(stored_documents)
+
+
+class LocalVectorIndex(SearchBackend):
+    """
+    In-process exact cosine search over a memory-mapped float32 matrix of
+    normalized product vectors.
+
+    Filters are evaluated by intersecting per-value posting lists, sorted
+    int32 row numbers built when the index is loaded. Indexes written with an
+    IVF index answer unselective queries approximately by scanning only the
+    `probes` inverted lists closest to the query; selective filters are always
+    scanned exactly, as are approximate queries whose probed lists hold fewer
+    than `top` matching rows.
+    """
+
+    def __init__(self, directory: str, probes: int = 8, exact_max_rows: int = 20000):
+        """
+        :param directory: The local index directory, see write_local_index.
+        :param probes: Inverted lists scanned per approximate query.
+        :param exact_max_rows: Queries matching at most this many rows are scanned exactly.
+        """
+        with open(os.path.join(directory, DOCUMENTS_FILE), "r") as f:
+            content = json.load(f)
+        self.documents = content["documents"]
+        self.dimensions = content["dimensions"]
+        self.probes = probes
+        self.exact_max_rows = exact_max_rows
+
+        self.vectors = np.memmap(os.path.join(directory, VECTORS_FILE), dtype=np.float32, mode="r",
+                                 shape=(len(self.documents), self.dimensions)) if self.documents \
+            else np.zeros((0, self.dimensions), dtype=np.float32)
+
+        self.rows_by_key = {document.get("index_number"): row for row, document in enumerate(self.documents)}
+        self.postings = {}
+        for name in FILTERABLE_FIELDS:
+            postings = {}
+            for row, document in enumerate(self.documents):
+                value = document.get(name)
+                if value is not None:
+                    postings.setdefault(value, []).append(row)
+            self.postings[name] = {value: np.array(rows, dtype=np.int32) for value, rows in postings.items()}
+
+        self.centroids = None
+        self.lists = None
+        ivf_path = os.path.join(directory, IVF_FILE)
+        if os.path.exists(ivf_path):
+            with np.load(ivf_path) as ivf:
+                self.set_ivf(ivf["centroids"], ivf["assignments"])
+
+    def set_ivf(self, centroids, assignments):
+        """
+        Uses an IVF index, see build_ivf, for approximate queries.
+        """
+        order = np.argsort(assignments, kind="stable")
+        boundaries = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+        order = order.astype(np.int32)
+        self.centroids = centroids
+        self.lists = [order[boundaries[i]:boundaries[i + 1]] for i in range(len(centroids))]
+
+    def __len__(self):
+        return len(self.documents)
+
+    def get_descriptions(self, keys):
+        return {key: self.documents[self.rows_by_key[key]].get("product_description")
+                for key in keys if key in self.rows_by_key}
+
+    def _filter_rows(self, filters):
+        """
+        Returns the sorted rows matching every filter, or None without filters.
+        """
+        rows = None
+        for name, value in (filters or {}).items():
+            if name not in self.postings:
+                raise ValueError(f"Field '{name}' is not filterable in the local index. "
+                                 f"Expected one of {list(FILTERABLE_FIELDS)}.")
+            postings = self.postings[name].get(value)
+            if postings is None:
+                return np.zeros(0, dtype=np.int32)
+            rows = postings if rows is None else np.intersect1d(rows, postings, assume_unique=True)
+        return rows
+
+    def _candidate_rows(self, query, filter_rows, top):
+        matching = len(self.documents) if filter_rows is None else len(filter_rows)
+        exact_rows = np.arange(len(self.documents)) if filter_rows is None else filter_rows
+        if self.lists is None or matching <= self.exact_max_rows:
+            return exact_rows
+
+        nearest_lists = np.argsort(-(self.centroids @ query))[:self.probes]
+        rows = np.sort(np.concatenate([self.lists[i] for i in nearest_lists]))
+        if filter_rows is not None:
+            rows = np.intersect1d(rows, filter_rows, assume_unique=True)
+        # The probed lists may hold too few matching rows; scan all of them instead
+        return rows if len(rows) >= min(top, matching) else exact_rows
+
+    def search(self, vector, filters=None, top=100, select=None, query_plan="vector", query_text=None):
+        validate_query_plan(query_plan)
+        if query_plan != "vector":
+            raise ValueError(f"The local index only supports the 'vector' query plan, not '{query_plan}'.")
+
+        query = np.asarray(vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+        rows = self._candidate_rows(query, self._filter_rows(filters), top)
+        if not len(rows) or top <= 0:
+            return []
+
+        similarities = self.vectors[rows] @ query
+        if len(rows) > top:
+            best = np.argpartition(-similarities, top - 1)[:top]
+        else:
+            best = np.arange(len(rows))
+        best = best[np.argsort(-similarities[best], kind="stable")]
+
+        select = select or RESULT_FIELDS
+        scores = cosine_search_score(similarities[best])
+        results = []
+        for row, score in zip(rows[best], scores):
+            document = self.documents[row]
+            result = {name: document.get(name) for name in select}
+            result["@search.score"] = float(score)
+            results.append(result)
+        return results
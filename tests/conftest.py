@@ -0,0 +1,17 @@
+import os
+import sys
+import streamlit
+
+
+class _TestSecrets(dict):
+    """
+    Secrets for importing the app modules without a secrets.toml; required
+    settings get a placeholder and optional ones keep their defaults.
+    """
+
+    def __missing__(self, name):
+        return "https://example.invalid/"
+
+
+streamlit.secrets = _TestSecrets()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,16 @@
+import numpy as np
+import benchmark_hnsw
+from search_backends import VECTOR_FIELD, LocalVectorIndex, write_local_index
+
+
+def test_ivf_fallback_reaches_full_recall_when_every_list_is_probed(tmp_path):
+    rng = np.random.default_rng(0)
+    documents = [{"index_number": str(i), VECTOR_FIELD: rng.normal(size=8).tolist()} for i in range(400)]
+    write_local_index(str(tmp_path), documents)
+    corpus = LocalVectorIndex(str(tmp_path))
+    queries = rng.normal(size=(5, 8)).astype(np.float32)
+
+    results = benchmark_hnsw.benchmark_local_ivf(corpus, queries, 10, probes=[1, len(documents)])
+
+    assert [result["algorithm"] for result in results] == ["exhaustive_knn", "ivf", "ivf"]
+    assert results[-1]["recall_at_k"] == 1.0
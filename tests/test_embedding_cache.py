@@ -0,0 +1,40 @@
+import azure_embeddings
+from embedding_cache import EmbeddingCache
+
+
+class _VisionClient:
+    def __init__(self, model_version):
+        self.model_version = model_version
+        self.texts = []
+
+    def vectorize_text(self, text):
+        self.texts.append(text)
+        return [float(len(text)), float(len(self.texts))], self.model_version
+
+
+def test_key_includes_endpoint_and_model_version():
+    key = EmbeddingCache.make_key("text", "red dress", "https://a.invalid/", "2024-02-01", "2023-04-15")
+    assert key == EmbeddingCache.make_key("text", "red dress", "https://a.invalid/", "2024-02-01", "2023-04-15")
+    assert key != EmbeddingCache.make_key("text", "red dress", "https://b.invalid/", "2024-02-01", "2023-04-15")
+    assert key != EmbeddingCache.make_key("text", "red dress", "https://a.invalid/", "2024-02-01", "2024-02-01")
+
+
+def test_model_version_change_invalidates_cached_vectors(tmp_path, monkeypatch):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite3"), 100)
+    client = _VisionClient("2023-04-15")
+    monkeypatch.setattr(azure_embeddings, "get_embedding_cache", lambda: cache)
+    monkeypatch.setattr(azure_embeddings, "get_embedding_client", lambda endpoint, key, version: client)
+
+    first = azure_embeddings.vectorize_text("red dress", "https://a.invalid/", "key", "2024-02-01")
+    assert azure_embeddings.vectorize_text("red dress", "https://a.invalid/", "key", "2024-02-01") == first
+    assert client.texts == ["red dress"]
+    assert cache.get_model_version("https://a.invalid/", azure_embeddings.VISION_MODEL_VERSION) == "2023-04-15"
+
+    # The service moves "latest" to a new model; the next miss reveals it
+    client.model_version = "2024-02-01"
+    azure_embeddings.vectorize_text("blue shirt", "https://a.invalid/", "key", "2024-02-01")
+    assert cache.get_model_version("https://a.invalid/", azure_embeddings.VISION_MODEL_VERSION) == "2024-02-01"
+
+    assert azure_embeddings.vectorize_text("red dress", "https://a.invalid/", "key", "2024-02-01") != first
+    assert client.texts == ["red dress", "blue shirt", "red dress"]
+    assert cache.stats()["hits"] == 1
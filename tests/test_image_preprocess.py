@@ -0,0 +1,29 @@
+import io
+import numpy as np
+from PIL import Image
+from image_preprocess import preprocess_image
+
+
+def _encode(image, image_format, **options):
+    buffered = io.BytesIO()
+    image.save(buffered, format=image_format, **options)
+    return buffered.getvalue()
+
+
+def test_resized_image_is_sent_even_when_larger_than_the_original():
+    noise = np.random.default_rng(0).integers(0, 255, (564, 400, 3)).astype("uint8")
+    data = _encode(Image.fromarray(noise), "WEBP", quality=5)
+
+    prepared = preprocess_image(data, 512)
+
+    assert len(prepared.data) > len(data)
+    assert max(Image.open(io.BytesIO(prepared.data)).size) == 512
+
+
+def test_small_image_is_sent_untouched():
+    data = _encode(Image.new("RGB", (100, 80), "red"), "PNG")
+
+    prepared = preprocess_image(data, 512)
+
+    assert prepared.data == data
+    assert prepared.mime_type == "image/png"
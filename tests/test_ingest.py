@@ -0,0 +1,63 @@
+import asyncio
+import azure_blob_storage
+import ingest
+import thumbnails
+from PIL import Image
+from primary_images import PrimaryImageIndex
+from vars import CONTAINER_NAME
+
+
+class _BlobClient:
+    def upload_blob(self, data, **options):
+        pass
+
+
+class _ContainerClient:
+    def get_blob_client(self, blob_name):
+        return _BlobClient()
+
+
+def test_failed_thumbnails_are_not_recorded(tmp_path, monkeypatch):
+    image_path = str(tmp_path / "front.png")
+    Image.new("RGB", (800, 600), "red").save(image_path)
+    primary_image_index = PrimaryImageIndex(str(tmp_path / "primary_images.json"))
+
+    def fail(*args, **kwargs):
+        raise OSError("cannot render")
+
+    monkeypatch.setattr(thumbnails, "render_thumbnails", fail)
+    monkeypatch.setattr(azure_blob_storage, "get_container_client", lambda *args: _ContainerClient())
+    monkeypatch.setattr(ingest, "get_primary_image_index", lambda: primary_image_index)
+
+    product = ingest.upload_product({"folder_name": "product", "image_paths": [image_path]},
+                                    "https://example.invalid/container")
+
+    [blob_name] = product["blob_names"]
+    assert primary_image_index.get(CONTAINER_NAME, "product") == blob_name
+    assert primary_image_index.get_display_blob(CONTAINER_NAME, blob_name, 150) == blob_name
+
+
+def test_bounded_async_map_limits_concurrency_and_closes_the_client(monkeypatch):
+    closed = []
+    running = {"now": 0, "max": 0}
+
+    async def close():
+        closed.append(asyncio.get_running_loop())
+
+    async def describe(item):
+        running["now"] += 1
+        running["max"] = max(running["max"], running["now"])
+        await asyncio.sleep(0.01)
+        running["now"] -= 1
+        if item["folder_name"] == "broken":
+            raise ValueError("no reply")
+        return item["folder_name"]
+
+    monkeypatch.setattr(ingest, "close_async_openai_client", close)
+    items = [{"folder_name": str(i)} for i in range(10)] + [{"folder_name": "broken"}]
+
+    results = list(ingest.bounded_async_map(describe, items, 3, "description"))
+
+    assert sorted(results) == sorted(str(i) for i in range(10))
+    assert running["max"] == 3
+    assert len(closed) == 1 and closed[0].is_closed()
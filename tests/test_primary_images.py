@@ -0,0 +1,22 @@
+from primary_images import PrimaryImageIndex
+
+
+def test_index_reloads_changes_saved_by_another_process(tmp_path):
+    path = str(tmp_path / "primary_images.json")
+    ingestion = PrimaryImageIndex(path)
+    ingestion.set("container", "product", "product/front1.png", [150])
+    ingestion.save()
+
+    app = PrimaryImageIndex(path)
+    app.set("container", "other", "other/side1.png")
+    assert app.get("container", "product") == "product/front1.png"
+    assert not app.reload_if_changed()
+
+    ingestion.set("container", "product", "product/front2.png", [150, 300])
+    ingestion.save()
+
+    assert app.reload_if_changed()
+    assert app.get("container", "product") == "product/front2.png"
+    assert app.get_display_blob("container", "product/front2.png", 300) == "thumbnails/product/front2.png.w300.webp"
+    # Entries this process has not saved yet survive the reload
+    assert app.get("container", "other") == "other/side1.png"
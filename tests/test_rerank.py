@@ -0,0 +1,56 @@
+import numpy as np
+import rerank
+from gpt_gen import RerankResult
+
+
+class _Backend:
+    def get_descriptions(self, keys):
+        return {}
+
+
+def _candidates(count):
+    # A large search score gap after the fifth candidate; flavour matches are spread
+    # over the list so the local order differs from the search order
+    return [{"index_number": str(i), "@search.score": (0.9 if i < 5 else 0.5) - i * 0.001,
+             "category": "Snacks", "brand": "Brand", "flavour": "Sea Salt" if i % 3 == 0 else "Cheddar",
+             "quantity": "5 Oz", "product_description": f"Product {i}."}
+            for i in range(count)]
+
+
+def test_local_then_gpt_keeps_the_local_head_ahead_of_the_tail(monkeypatch):
+    prompted = []
+
+    def fake_rerank(items, image_path, candidate_ids=None, on_index=None):
+        prompted.append(candidate_ids)
+        # The model only names its three best items
+        for index in (2, 0, 1):
+            on_index(index)
+        return RerankResult([2, 0, 1])
+
+    monkeypatch.setattr(rerank, "generate_top_n_search_results", fake_rerank)
+    monkeypatch.setattr(rerank, "get_search_backend", lambda: _Backend())
+
+    candidates = _candidates(40)
+    query = {"category": "Snacks", "flavour": "Sea Salt", "quantity": "5 Oz"}
+    local_order = rerank.local_rerank(candidates, None, query).indices
+    head, tail = local_order[:20], local_order[20:]
+
+    emitted = []
+    result = rerank.local_then_gpt_rerank(candidates, None, query, top_k=20, on_index=emitted.append)
+
+    # The whole local head reaches the prompt; its score gaps do not cut it
+    assert prompted == [[candidates[i]["index_number"] for i in head]]
+    assert result.indices[:3] == [head[2], head[0], head[1]]
+    assert result.indices[3:20] == [i for i in head if i not in (head[0], head[1], head[2])]
+    assert result.indices[20:] == tail
+    assert emitted == result.indices
+
+
+def test_category_is_only_scored_with_a_classifier():
+    candidates = _candidates(4)
+    query = {"category": "Snacks", "flavour": "Sea Salt", "quantity": "5 Oz"}
+
+    unclassified = rerank.local_scores(candidates, query)
+    classified = rerank.local_scores(candidates, query, lambda query, candidates: [0.0, 1.0, 0.0, 0.0])
+
+    assert np.allclose(classified - unclassified, [0.0, rerank.LOCAL_SCORE_WEIGHTS["category"], 0.0, 0.0])
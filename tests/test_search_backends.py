@@ -0,0 +1,79 @@
+import numpy as np
+from search_backends import VECTOR_FIELD, AzureSearchBackend, LocalVectorIndex, PagedSearchResults, \
+    write_local_index
+
+
+class _SearchClient:
+    def __init__(self, count):
+        self.count = count
+        self.requests = []
+
+    def search(self, vector_queries, top, skip=None, **options):
+        skip = skip or 0
+        self.requests.append((skip, top))
+        return [{"index_number": str(i), "@search.score": 1.0 - i / 1000}
+                for i in range(skip, min(skip + top, self.count))]
+
+
+def test_pages_after_the_first_come_from_one_request():
+    client = _SearchClient(100)
+    pages = AzureSearchBackend(client).search_pages([0.0], top=100, page_size=20)
+
+    assert [result["index_number"] for result in pages.next_page()] == [str(i) for i in range(20)]
+    assert [result["index_number"] for result in pages.fetch_all()] == [str(i) for i in range(100)]
+    assert sorted(client.requests) == [(0, 20), (20, 80)]
+    assert not pages.has_more
+
+
+def test_short_first_page_ends_the_results():
+    client = _SearchClient(7)
+    pages = AzureSearchBackend(client).search_pages([0.0], top=100, page_size=20)
+
+    assert len(list(pages)) == 7
+    assert not pages.has_more
+
+
+def test_pages_are_sliced_from_the_remainder():
+    pages = PagedSearchResults(lambda skip, count: list(range(skip, min(skip + count, 45))), 20, 100)
+
+    assert [len(pages.next_page()) for _ in range(4)] == [20, 20, 5, 0]
+    assert pages.results == list(range(45))
+
+
+def test_local_index_approximate_search_falls_back_to_exact(tmp_path):
+    rng = np.random.default_rng(0)
+    documents = [{"index_number": str(i), "category": f"c{i % 3}", "brand": f"b{i % 50}",
+                  VECTOR_FIELD: rng.normal(size=16).tolist()} for i in range(3000)]
+    write_local_index(str(tmp_path), documents, ivf_min_documents=1000)
+    query = rng.normal(size=16)
+    filters = {"category": "c1", "brand": "b7"}
+
+    approximate = LocalVectorIndex(str(tmp_path), probes=1, exact_max_rows=10)
+    exact = LocalVectorIndex(str(tmp_path), exact_max_rows=len(documents))
+
+    assert approximate.lists is not None
+    # One probed list holds only a few of the 20 matching rows, so the search scans all of them
+    assert approximate.search(query, filters, top=100) == exact.search(query, filters, top=100)
+    assert len(exact.search(query, filters, top=100)) == 20
+    assert approximate.search(query, {"brand": "missing"}) == []
+
+
+def test_semantic_results_are_scored_by_the_ranker():
+    class _SemanticClient(_SearchClient):
+        def search(self, vector_queries, top, skip=None, **options):
+            return [{**result, "@search.reranker_score": 3.0 - i / 10}
+                    for i, result in enumerate(super().search(vector_queries, top, skip, **options))]
+
+    results = AzureSearchBackend(_SemanticClient(5)).search([0.0], top=5, query_plan="semantic", query_text="chips")
+
+    assert [result["@search.score"] for result in results] == [3.0, 2.9, 2.8, 2.7, 2.6]
+
+
+def test_semantic_plans_are_paged_from_one_request():
+    client = _SearchClient(100)
+    pages = AzureSearchBackend(client).search_pages([0.0], top=100, page_size=20, query_plan="semantic",
+                                                    query_text="chips")
+
+    assert len(pages.next_page()) == 20
+    assert [result["index_number"] for result in pages.fetch_all()] == [str(i) for i in range(100)]
+    assert client.requests == [(0, 100)]
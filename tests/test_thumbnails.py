@@ -0,0 +1,15 @@
+import io
+from PIL import Image
+from thumbnails import encode_local_thumbnail
+
+
+def test_local_thumbnail_width_applies_after_exif_rotation(tmp_path):
+    image_path = str(tmp_path / "rotated.jpg")
+    exif = Image.Exif()
+    exif[0x0112] = 6  # Rotated 90 degrees: the 400x1200 stored image is displayed 1200 wide
+    Image.new("RGB", (400, 1200), "red").save(image_path, format="JPEG", exif=exif)
+
+    data, mime_type = encode_local_thumbnail(image_path, 300)
+
+    assert mime_type == "image/jpeg"
+    assert Image.open(io.BytesIO(data)).size == (300, 100)
@@ -0,0 +1,40 @@
+import json
+from azure.core.exceptions import ResourceNotFoundError
+import utils
+from vars import AZURE_SEARCH_INDEX_NAME
+
+
+class _AdminClient:
+    def __init__(self, exists):
+        self.exists = exists
+        self.created = []
+
+    def get_index(self, name):
+        if not self.exists:
+            raise ResourceNotFoundError("index not found")
+        return name
+
+    def create_or_update_index(self, index):
+        self.created.append(index.name)
+        self.exists = True
+        return index
+
+
+def _run_ensure(tmp_path, monkeypatch, exists):
+    fingerprint_path = str(tmp_path / "schema.json")
+    with open(fingerprint_path, "w") as f:
+        json.dump({AZURE_SEARCH_INDEX_NAME: utils.get_schema_fingerprint(utils.build_search_index())}, f)
+
+    admin_client = _AdminClient(exists)
+    monkeypatch.setattr(utils, "SEARCH_SCHEMA_FINGERPRINT_PATH", fingerprint_path)
+    monkeypatch.setattr(utils, "admin_client", admin_client)
+    monkeypatch.setattr(utils, "mark_index_changed", lambda: None)
+    return utils.ensure_search_index(), admin_client.created
+
+
+def test_matching_fingerprint_skips_an_existing_index(tmp_path, monkeypatch):
+    assert _run_ensure(tmp_path, monkeypatch, exists=True) == (False, [])
+
+
+def test_missing_index_is_recreated_despite_a_matching_fingerprint(tmp_path, monkeypatch):
+    assert _run_ensure(tmp_path, monkeypatch, exists=False) == (True, [AZURE_SEARCH_INDEX_NAME])
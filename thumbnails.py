@@ -0,0 +1,160 @@
+import base64
+import io
+import os
+import re
+import threading
+from collections import OrderedDict
+from azure.storage.blob import ContentSettings
+from PIL import Image, ImageOps
+from vars import THUMBNAIL_WIDTHS
+
+
+THUMBNAIL_PREFIX = "thumbnails"
+THUMBNAIL_FORMAT = "WEBP"
+THUMBNAIL_CONTENT_TYPE = "image/webp"
+THUMBNAIL_QUALITY = 80
+
+_thumbnail_blob_pattern = re.compile(rf"^{THUMBNAIL_PREFIX}/(.+)\.w(\d+)\.webp$")
+
+LOCAL_THUMBNAIL_CACHE_SIZE = 64
+LOCAL_THUMBNAIL_QUALITY = 85
+
+_local_thumbnail_cache = OrderedDict()
+_local_thumbnail_cache_lock = threading.Lock()
+
+
+def thumbnail_blob_name(blob_name: str, width: int):
+    """
+    Returns the name of the thumbnail blob of `blob_name` at `width` pixels,
+    stored under a prefix parallel to the original blob.
+    """
+    return f"{THUMBNAIL_PREFIX}/{blob_name}.w{width}.webp"
+
+
+def parse_thumbnail_blob_name(blob_name: str):
+    """
+    Parses a thumbnail blob name.
+
+    :return: A tuple of (original blob name, width), or None if `blob_name` is not a thumbnail.
+    """
+    match = _thumbnail_blob_pattern.match(blob_name)
+    if match is None:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+def pick_thumbnail_width(available_widths, display_width: int):
+    """
+    Picks the smallest available width that covers `display_width`, or the
+    largest one if none does.
+    """
+    available_widths = sorted(available_widths)
+    for width in available_widths:
+        if width >= display_width:
+            return width
+    return available_widths[-1]
+
+
+def render_thumbnails(data: bytes, widths=THUMBNAIL_WIDTHS):
+    """
+    Renders resized WebP renditions of an image.
+
+    Images are never upscaled: renditions wider than the original are encoded
+    at the original size, so every configured width always exists.
+
+    :param data: The original image bytes.
+    :param widths: The widths to render, in pixels.
+    :return: A dict mapping each width to the encoded thumbnail bytes.
+    """
+    image = Image.open(io.BytesIO(data))
+    image.draft("RGB", (max(widths), max(widths)))
+    image = ImageOps.exif_transpose(image)
+    image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+
+    thumbnails = {}
+    for width in sorted(widths, reverse=True):
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))),
+                                 Image.Resampling.LANCZOS)
+
+        buffered = io.BytesIO()
+        image.save(buffered, format=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY, method=4)
+        thumbnails[width] = buffered.getvalue()
+
+    return thumbnails
+
+
+def upload_thumbnails(container_client, blob_name: str, data: bytes, widths=THUMBNAIL_WIDTHS):
+    """
+    Renders and uploads the thumbnails of an image blob.
+
+    :param container_client: The ContainerClient of the original blob.
+    :param blob_name: The name of the original blob.
+    :param data: The original image bytes.
+    :param widths: The widths to render, in pixels.
+    :return: The names of the uploaded thumbnail blobs.
+    """
+    thumbnail_names = []
+    for width, thumbnail in render_thumbnails(data, widths).items():
+        thumbnail_name = thumbnail_blob_name(blob_name, width)
+        container_client.get_blob_client(thumbnail_name).upload_blob(
+            thumbnail, overwrite=True,
+            content_settings=ContentSettings(content_type=THUMBNAIL_CONTENT_TYPE,
+                                             cache_control="public, max-age=31536000, immutable"))
+        thumbnail_names.append(thumbnail_name)
+
+    return thumbnail_names
+
+
+def encode_local_thumbnail(image_path: str, width: int):
+    """
+    Encodes a local image at display size, memoized by path, modification
+    time and width in a bounded in-memory LRU cache.
+
+    JPEGs are decoded at a reduced scale (draft mode) and other formats are
+    reduced by an integer factor before resampling, so the full-size image is
+    never decoded. Opaque images are emitted as JPEG, images with transparency
+    as WebP.
+
+    :param image_path: The local image path.
+    :param width: The maximum width of the encoded image, in pixels.
+    :return: A tuple of (encoded bytes, MIME type).
+    """
+    cache_key = (image_path, os.path.getmtime(image_path), width)
+    with _local_thumbnail_cache_lock:
+        cached = _local_thumbnail_cache.get(cache_key)
+        if cached is not None:
+            _local_thumbnail_cache.move_to_end(cache_key)
+            return cached
+
+    image = Image.open(image_path)
+    # Both sides stay at least `width` wide, as the EXIF orientation may swap them
+    image.draft("RGB", (width, width))
+    image = ImageOps.exif_transpose(image)
+    if image.width > width:
+        # thumbnail() applies reduce() for the reducing gap
+        image.thumbnail((width, image.height), Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+    buffered = io.BytesIO()
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image.convert("RGBA").save(buffered, format="WEBP", quality=LOCAL_THUMBNAIL_QUALITY, method=4)
+        encoded = (buffered.getvalue(), "image/webp")
+    else:
+        image.convert("RGB").save(buffered, format="JPEG", quality=LOCAL_THUMBNAIL_QUALITY, optimize=True)
+        encoded = (buffered.getvalue(), "image/jpeg")
+
+    with _local_thumbnail_cache_lock:
+        _local_thumbnail_cache[cache_key] = encoded
+        _local_thumbnail_cache.move_to_end(cache_key)
+        while len(_local_thumbnail_cache) > LOCAL_THUMBNAIL_CACHE_SIZE:
+            _local_thumbnail_cache.popitem(last=False)
+
+    return encoded
+
+
+def local_image_data_uri(image_path: str, width: int):
+    """
+    Returns a base64 data URI of a local image encoded at display size.
+    """
+    data, mime_type = encode_local_thumbnail(image_path, width)
+    return f"data:{mime_type};base64,{base64.b64encode(data).decode()}"
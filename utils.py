@@ -1,18 +1,28 @@
+import hashlib
 import json
 import os
+import threading
+import uuid
+from dataclasses import dataclass
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceNotFoundError
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
     ExhaustiveKnnAlgorithmConfiguration, ExhaustiveKnnParameters,
     SearchIndex, SearchField, SearchFieldDataType, SearchableField, SearchIndex,
     SemanticConfiguration, SemanticPrioritizedFields, SemanticField, SemanticSearch, VectorSearch,
-    HnswAlgorithmConfiguration, HnswParameters, VectorSearchAlgorithmKind, VectorSearchProfile, VectorSearchAlgorithmMetric
+    HnswAlgorithmConfiguration, HnswParameters, VectorSearchAlgorithmKind, VectorSearchProfile, VectorSearchAlgorithmMetric,
+    BinaryQuantizationCompression, ScalarQuantizationCompression, ScalarQuantizationParameters
 )
-from azure.search.documents.models import QueryAnswerType, QueryCaptionType, QueryType, VectorizedQuery
+from azure_blob_storage import get_container_client
 from azure_embeddings import vectorize_image_with_filepath
+from search_backends import DISPLAY_FIELDS, AzureSearchBackend, LocalVectorIndex, build_query_text
 from vars import AZURE_SEARCH_SERVICE_ENDPOINT, AZURE_SEARCH_INDEX_NAME, AZURE_SEARCH_INDEX_KEY, \
-    VISION_ENDPOINT, VISION_VERSION, VISION_SUBSCRIPTION_KEY
+    VISION_ENDPOINT, VISION_VERSION, VISION_SUBSCRIPTION_KEY, SEARCH_SCHEMA_FINGERPRINT_PATH, \
+    SEARCH_INDEX_VERSION, SEARCH_BACKEND, LOCAL_INDEX_PATH, LOCAL_INDEX_IVF_PROBES, SEARCH_VECTOR_COMPRESSION, \
+    SEARCH_VECTOR_TYPE, SEARCH_VECTOR_RETRIEVABLE, SEARCH_VECTOR_STORED, SEARCH_VECTOR_OVERSAMPLING, SEARCH_QUERY_PLAN, \
+    SEARCH_TOP, SEARCH_PAGE_SIZE, BLOB_CONNECTION_STRING, CONTAINER_NAME
 azure_search_credential = AzureKeyCredential(AZURE_SEARCH_INDEX_KEY)
 
 
@@ -21,7 +31,76 @@ admin_client = SearchIndexClient(endpoint=AZURE_SEARCH_SERVICE_ENDPOINT, index_n
 search_client = SearchClient(endpoint=AZURE_SEARCH_SERVICE_ENDPOINT, index_name=AZURE_SEARCH_INDEX_NAME, credential=azure_search_credential)
 
 
-def create_search_index_in_azure_ai_search():
+VECTOR_TYPES = {
+    "single": SearchFieldDataType.Collection(SearchFieldDataType.Single),
+    "half": SearchFieldDataType.Collection("Edm.Half"),
+}
+COMPRESSION_NAME = "myVectorCompression"
+DEFAULT_HNSW_PARAMETERS = {"m": 4, "ef_construction": 400, "ef_search": 500}
+# Metadata key of the product image container holding a token that changes with the indexed documents
+INGEST_VERSION_METADATA_KEY = "ingest_version"
+
+
+@dataclass
+class VectorSchemaOptions:
+    """
+    Storage options of the product_description_vector field.
+
+    :param compression: "none", "scalar" (int8) or "binary" (1 bit per dimension) quantization.
+    :param vector_type: "single" (float32) or "half" (float16) vector elements.
+    :param retrievable: Whether vectors can be returned by queries.
+    :param stored: Whether a retrievable copy of the vectors is stored; requires retrievable.
+    :param oversampling: With compression, the factor of extra candidates that
+        are rescored with the full-precision vectors.
+    """
+    compression: str = SEARCH_VECTOR_COMPRESSION
+    vector_type: str = SEARCH_VECTOR_TYPE
+    retrievable: bool = SEARCH_VECTOR_RETRIEVABLE
+    stored: bool = SEARCH_VECTOR_STORED
+    oversampling: float = SEARCH_VECTOR_OVERSAMPLING
+
+    def validate(self):
+        if self.compression not in ("none", "scalar", "binary"):
+            raise ValueError(f"Unknown vector compression '{self.compression}'. "
+                             f"Expected 'none', 'scalar' or 'binary'.")
+        if self.vector_type not in VECTOR_TYPES:
+            raise ValueError(f"Unknown vector type '{self.vector_type}'. Expected one of {sorted(VECTOR_TYPES)}.")
+        if self.retrievable and not self.stored:
+            raise ValueError("Retrievable vectors have to be stored.")
+
+
+def build_vector_compressions(options):
+    """
+    Builds the compression configuration of the vector search, if any.
+    """
+    if options.compression == "scalar":
+        return [ScalarQuantizationCompression(
+            compression_name=COMPRESSION_NAME, rerank_with_original_vectors=True,
+            default_oversampling=options.oversampling,
+            parameters=ScalarQuantizationParameters(quantized_data_type="int8"))]
+    if options.compression == "binary":
+        return [BinaryQuantizationCompression(
+            compression_name=COMPRESSION_NAME, rerank_with_original_vectors=True,
+            default_oversampling=options.oversampling)]
+    return []
+
+
+def build_search_index(vector_options=None, name=AZURE_SEARCH_INDEX_NAME, hnsw_parameters=None):
+    """
+    Builds the SearchIndex definition (fields, vector and semantic configuration)
+    of the product index.
+
+    :param vector_options: VectorSchemaOptions of the vector field; defaults to
+        the SEARCH_VECTOR_* settings of the deployment.
+    :param name: The name of the index.
+    :param hnsw_parameters: m, ef_construction and ef_search of the HNSW
+        algorithm; defaults to DEFAULT_HNSW_PARAMETERS.
+    """
+    vector_options = vector_options or VectorSchemaOptions()
+    hnsw_parameters = {**DEFAULT_HNSW_PARAMETERS, **(hnsw_parameters or {})}
+    vector_options.validate()
+    compressions = build_vector_compressions(vector_options)
+
     fields = [
         SearchableField(name="index_number", type=SearchFieldDataType.String, key=True,
                         searchable=True, filterable=True, retrievable=True),
@@ -37,8 +116,11 @@ def create_search_index_in_azure_ai_search():
                         searchable=True, filterable=True, retrievable=True),
         SearchableField(name="product_description", type=SearchFieldDataType.String,
                         searchable=True, filterable=True, retrievable=True),
-        SearchField(name="product_description_vector", type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
-                    searchable=True, retrievable=True, vector_search_dimensions=1024, vector_search_profile_name="myHnswProfile")
+        SearchField(name="product_description_vector", type=VECTOR_TYPES[vector_options.vector_type],
+                    # SearchField takes hidden, not retrievable; stored is only sent when it differs from the default
+                    searchable=True, hidden=not vector_options.retrievable or None,
+                    stored=None if vector_options.stored else False,
+                    vector_search_dimensions=1024, vector_search_profile_name="myHnswProfile")
     ]
 
     # Configure the vector search configuration
@@ -48,9 +130,9 @@ def create_search_index_in_azure_ai_search():
                 name="myHnsw",
                 kind=VectorSearchAlgorithmKind.HNSW,
                 parameters=HnswParameters(
-                    m=4,
-                    ef_construction=400,
-                    ef_search=500,
+                    m=hnsw_parameters["m"],
+                    ef_construction=hnsw_parameters["ef_construction"],
+                    ef_search=hnsw_parameters["ef_search"],
                     metric=VectorSearchAlgorithmMetric.COSINE
                 )
             ),
@@ -66,12 +148,14 @@ def create_search_index_in_azure_ai_search():
             VectorSearchProfile(
                 name="myHnswProfile",
                 algorithm_configuration_name="myHnsw",
+                compression_name=COMPRESSION_NAME if compressions else None,
             ),
             VectorSearchProfile(
                 name="myExhaustiveKnnProfile",
                 algorithm_configuration_name="myExhaustiveKnn",
             )
-        ]
+        ],
+        compressions=compressions or None
     )
 
     semantic_config = SemanticConfiguration(
@@ -86,32 +170,160 @@ def create_search_index_in_azure_ai_search():
     semantic_search = SemanticSearch(configurations=[semantic_config])
 
     # Create the search index with the semantic settings
-    index = SearchIndex(name=AZURE_SEARCH_INDEX_NAME, fields=fields,
-                        vector_search=vector_search, semantic_search=semantic_search)
+    return SearchIndex(name=name, fields=fields,
+                       vector_search=vector_search, semantic_search=semantic_search)
+
+
+def get_schema_fingerprint(index):
+    """
+    Hashes a SearchIndex definition so schema changes can be detected locally.
+    """
+    return hashlib.sha256(json.dumps(index.serialize(), sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def create_search_index_in_azure_ai_search():
+    index = build_search_index()
     result = admin_client.create_or_update_index(index)
     print(f' {result.name} created')
+    mark_index_changed()
+    return get_schema_fingerprint(index)
+
+
+def _search_index_exists():
+    try:
+        admin_client.get_index(AZURE_SEARCH_INDEX_NAME)
+    except ResourceNotFoundError:
+        return False
+    return True
+
+
+def ensure_search_index():
+    """
+    Creates or updates the search index only when its field or vector
+    configuration differs from the one last applied, as recorded in the
+    schema fingerprint file, or when the index does not exist on the service
+    (e.g. it was deleted, or the fingerprint file was copied from another host).
+
+    :return: True if the index was created or updated.
+    """
+    fingerprint = get_schema_fingerprint(build_search_index())
 
+    fingerprints = {}
+    if os.path.exists(SEARCH_SCHEMA_FINGERPRINT_PATH):
+        with open(SEARCH_SCHEMA_FINGERPRINT_PATH, 'r') as f:
+            fingerprints = json.load(f)
 
-def similarity_search_via_image(file_path, category, brand):
+    if fingerprints.get(AZURE_SEARCH_INDEX_NAME) == fingerprint and _search_index_exists():
+        return False
 
+    fingerprints[AZURE_SEARCH_INDEX_NAME] = create_search_index_in_azure_ai_search()
+
+    directory = os.path.dirname(SEARCH_SCHEMA_FINGERPRINT_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(SEARCH_SCHEMA_FINGERPRINT_PATH, 'w') as f:
+        json.dump(fingerprints, f, indent=2)
+    return True
+
+
+def mark_index_changed():
+    """
+    Records that the search index changed, e.g. after an ingestion batch, as
+    a new token in the metadata of the product image container. Every host
+    running the app reads it through get_index_version.
+    """
+    container_client = get_container_client(BLOB_CONNECTION_STRING, CONTAINER_NAME)
+    metadata = dict(container_client.get_container_properties().metadata or {})
+    metadata[INGEST_VERSION_METADATA_KEY] = uuid.uuid4().hex
+    container_client.set_container_metadata(metadata)
+
+
+def get_ingest_version():
+    """
+    Returns the token last written by mark_index_changed, or None.
+    """
+    try:
+        properties = get_container_client(BLOB_CONNECTION_STRING, CONTAINER_NAME).get_container_properties()
+    except ResourceNotFoundError:
+        return None
+    return (properties.metadata or {}).get(INGEST_VERSION_METADATA_KEY)
+
+
+def get_index_version():
+    """
+    Identifies the current state of the search index from the token that
+    ingestion and index updates write (see mark_index_changed), its document
+    count and the SEARCH_INDEX_VERSION setting, or, with the local backend,
+    from the files of the local index.
+
+    :return: A short hex digest that changes when the index changes.
+    """
+    if SEARCH_BACKEND == "local":
+        state = [SEARCH_BACKEND, len(get_search_backend()), SEARCH_INDEX_VERSION] + sorted(
+            (name, os.path.getmtime(os.path.join(LOCAL_INDEX_PATH, name))) for name in os.listdir(LOCAL_INDEX_PATH))
+        return hashlib.sha256(json.dumps(state).encode("utf-8")).hexdigest()[:16]
+
+    state = [AZURE_SEARCH_INDEX_NAME, get_ingest_version(), search_client.get_document_count(), SEARCH_INDEX_VERSION]
+    return hashlib.sha256(json.dumps(state).encode("utf-8")).hexdigest()[:16]
+
+
+_search_backends = {}
+_search_backends_lock = threading.Lock()
+
+
+def get_search_backend(name=SEARCH_BACKEND):
+    """
+    Returns the process-wide search backend: "azure" or "local".
+    """
+    with _search_backends_lock:
+        return _get_search_backend(name)
+
+
+def _get_search_backend(name):
+    if name not in _search_backends:
+        if name == "azure":
+            _search_backends[name] = AzureSearchBackend(search_client)
+        elif name == "local":
+            _search_backends[name] = LocalVectorIndex(LOCAL_INDEX_PATH, probes=LOCAL_INDEX_IVF_PROBES)
+        else:
+            raise ValueError(f"Unknown search backend '{name}'. Expected 'azure' or 'local'.")
+    return _search_backends[name]
+
+
+def similarity_search_pages(file_path, category, brand, page_size=SEARCH_PAGE_SIZE, top=SEARCH_TOP,
+                            query_plan=SEARCH_QUERY_PLAN, query_text=None):
+    """
+    Finds the products most similar to an image within its category and brand,
+    one page of results at a time.
+
+    :param file_path: The query image filepath.
+    :param category: The category results are filtered on.
+    :param brand: The brand results are filtered on.
+    :param page_size: The number of results per page.
+    :param top: The total number of results.
+    :param query_plan: "vector", "hybrid", "semantic" or "semantic-captions".
+    :param query_text: The full-text query of the non-vector plans; defaults
+        to the brand and category.
+    :return: PagedSearchResults with the short display fields of the results;
+        descriptions are looked up with get_search_backend().get_descriptions.
+    """
     image_embedding = vectorize_image_with_filepath(file_path, VISION_ENDPOINT, VISION_SUBSCRIPTION_KEY, VISION_VERSION)
-    image_vector_query = VectorizedQuery(
-        vector=image_embedding, k_nearest_neighbors=100, fields="product_description_vector")
-
-    text_results = search_client.search(
-        vector_queries=[image_vector_query],
-        select=["product_folder_link",
-                "product_description",
-                "category",
-                "brand",
-                "flavour",
-                "quantity"],
-        filter=f"category eq '{category}' and brand eq '{brand}'",
-        query_type=QueryType.SEMANTIC, semantic_configuration_name='my-semantic-config', query_caption=QueryCaptionType.EXTRACTIVE, query_answer=QueryAnswerType.EXTRACTIVE,
-        top=100
-    )
+    if query_text is None and query_plan != "vector":
+        query_text = build_query_text({"brand": brand, "category": category})
+    return get_search_backend().search_pages(
+        image_embedding, filters={"category": category, "brand": brand}, top=top, page_size=page_size,
+        select=DISPLAY_FIELDS, query_plan=query_plan, query_text=query_text)
+
+
+def similarity_search_via_image(file_path, category, brand, query_plan=SEARCH_QUERY_PLAN, query_text=None):
+    """
+    Finds the products most similar to an image within its category and brand.
 
-    return list(text_results)
+    :return: All search results, best first; see similarity_search_pages.
+    """
+    # Callers that need every result get them in a single request
+    return similarity_search_pages(file_path, category, brand, page_size=SEARCH_TOP, query_plan=query_plan,
+                                   query_text=query_text).fetch_all()
 
 
 def get_images_and_json(folder_path):
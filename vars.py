@@ -36,4 +36,83 @@ BLOB_CONNECTION_STRING = st.secrets["BLOB_CONNECTION_STRING"]
 CONTAINER_NAME = st.secrets["CONTAINER_NAME"]
 
 USERNAME = st.secrets["USERNAME"]
-PASSWORD = st.secrets["PASSWORD"]
\ No newline at end of file
+PASSWORD = st.secrets["PASSWORD"]
+
+# Optional settings (fall back to defaults when absent from secrets)
+VISION_MODEL_VERSION = st.secrets.get("VISION_MODEL_VERSION", "latest")
+
+EMBEDDING_CACHE_PATH = st.secrets.get("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite3")
+EMBEDDING_CACHE_MAX_ENTRIES = int(st.secrets.get("EMBEDDING_CACHE_MAX_ENTRIES", 50000))
+
+VISION_CONNECT_TIMEOUT = float(st.secrets.get("VISION_CONNECT_TIMEOUT", 3.05))
+VISION_READ_TIMEOUT = float(st.secrets.get("VISION_READ_TIMEOUT", 20))
+VISION_MAX_RETRIES = int(st.secrets.get("VISION_MAX_RETRIES", 3))
+VISION_BACKOFF_FACTOR = float(st.secrets.get("VISION_BACKOFF_FACTOR", 0.5))
+VISION_POOL_SIZE = int(st.secrets.get("VISION_POOL_SIZE", 16))
+
+SEARCH_SCHEMA_FINGERPRINT_PATH = st.secrets.get("SEARCH_SCHEMA_FINGERPRINT_PATH", ".cache/search_index_schema.json")
+
+PRIMARY_IMAGE_INDEX_PATH = st.secrets.get("PRIMARY_IMAGE_INDEX_PATH", ".cache/primary_images.json")
+
+THUMBNAIL_WIDTHS = tuple(int(width) for width in st.secrets.get("THUMBNAIL_WIDTHS", [150, 300, 600]))
+
+RERANK_CACHE_PATH = st.secrets.get("RERANK_CACHE_PATH", ".cache/rerank.sqlite3")
+RERANK_CACHE_TTL_SECONDS = float(st.secrets.get("RERANK_CACHE_TTL_SECONDS", 7 * 24 * 3600))
+
+# "json_object" works with every JSON-mode deployment; "json_schema" needs api-version 2024-08-01-preview or later
+RERANK_RESPONSE_FORMAT = st.secrets.get("RERANK_RESPONSE_FORMAT", "json_object")
+AZURE_OPENAI_MAX_RETRIES = int(st.secrets.get("AZURE_OPENAI_MAX_RETRIES", 2))
+
+# One of "gpt", "local" or "local-then-gpt" (local scoring, then GPT over the local top RERANK_TOP_K)
+RERANK_MODE = st.secrets.get("RERANK_MODE", "gpt")
+RERANK_TOP_K = int(st.secrets.get("RERANK_TOP_K", 20))
+
+RERANK_PROMPT_TOKEN_BUDGET = int(st.secrets.get("RERANK_PROMPT_TOKEN_BUDGET", 6000))
+RERANK_DESCRIPTION_TOKENS = int(st.secrets.get("RERANK_DESCRIPTION_TOKENS", 120))
+RERANK_MIN_CANDIDATES = int(st.secrets.get("RERANK_MIN_CANDIDATES", 10))
+RERANK_MAX_CANDIDATES = int(st.secrets.get("RERANK_MAX_CANDIDATES", 50))
+
+# Number of concurrent rerank calls the candidates are split across, merged with "rrf" or "tournament"
+RERANK_SHARDS = int(st.secrets.get("RERANK_SHARDS", 1))
+RERANK_FUSION = st.secrets.get("RERANK_FUSION", "rrf")
+
+# Largest side of query images sent to the Vision embedding API
+VISION_IMAGE_MAX_SIDE = int(st.secrets.get("VISION_IMAGE_MAX_SIDE", 512))
+# GPT vision models scale images to fit 2048x2048 and then to a 768 px shortest side
+GPT_IMAGE_MAX_SIDE = int(st.secrets.get("GPT_IMAGE_MAX_SIDE", 2048))
+GPT_IMAGE_SHORT_SIDE = int(st.secrets.get("GPT_IMAGE_SHORT_SIDE", 768))
+
+AZURE_OPENAI_MAX_CONNECTIONS = int(st.secrets.get("AZURE_OPENAI_MAX_CONNECTIONS", 64))
+AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(st.secrets.get("AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", 32))
+AZURE_OPENAI_CONNECT_TIMEOUT = float(st.secrets.get("AZURE_OPENAI_CONNECT_TIMEOUT", 5))
+AZURE_OPENAI_READ_TIMEOUT = float(st.secrets.get("AZURE_OPENAI_READ_TIMEOUT", 120))
+
+RESULT_STORE_PATH = st.secrets.get("RESULT_STORE_PATH", ".cache/results.sqlite3")
+# Bump to invalidate stored results by hand; ingestion and index updates are detected automatically
+SEARCH_INDEX_VERSION = st.secrets.get("SEARCH_INDEX_VERSION", "")
+INDEX_VERSION_CHECK_SECONDS = float(st.secrets.get("INDEX_VERSION_CHECK_SECONDS", 300))
+
+# "azure" queries the Azure AI Search index, "local" an in-process index exported with export_local_index.py
+SEARCH_BACKEND = st.secrets.get("SEARCH_BACKEND", "azure")
+LOCAL_INDEX_PATH = st.secrets.get("LOCAL_INDEX_PATH", ".cache/local_index")
+# Local indexes of at least this many documents get an approximate (IVF) index
+LOCAL_INDEX_IVF_MIN_DOCUMENTS = int(st.secrets.get("LOCAL_INDEX_IVF_MIN_DOCUMENTS", 100000))
+LOCAL_INDEX_IVF_PROBES = int(st.secrets.get("LOCAL_INDEX_IVF_PROBES", 8))
+
+# Vector field schema of the search index; changing any of these requires recreating the index and re-ingesting.
+# Compression is "none", "scalar" (int8) or "binary" (1 bit per dimension); type is "single" (float32) or "half" (float16).
+SEARCH_VECTOR_COMPRESSION = st.secrets.get("SEARCH_VECTOR_COMPRESSION", "none")
+SEARCH_VECTOR_TYPE = st.secrets.get("SEARCH_VECTOR_TYPE", "single")
+# Non-retrievable vectors are never returned; non-stored vectors also drop the retrievable copy from storage
+SEARCH_VECTOR_RETRIEVABLE = str(st.secrets.get("SEARCH_VECTOR_RETRIEVABLE", True)).lower() == "true"
+SEARCH_VECTOR_STORED = str(st.secrets.get("SEARCH_VECTOR_STORED", True)).lower() == "true"
+# Compressed indexes fetch oversampling * k candidates and rescore them with the full-precision vectors
+SEARCH_VECTOR_OVERSAMPLING = float(st.secrets.get("SEARCH_VECTOR_OVERSAMPLING", 4.0))
+
+# "vector" (default), "hybrid" (adds a full-text query built from the product metadata),
+# "semantic" (hybrid plus the semantic ranker) or "semantic-captions" (also extractive captions and answers)
+SEARCH_QUERY_PLAN = st.secrets.get("SEARCH_QUERY_PLAN", "vector")
+
+# Number of search results per query, fetched SEARCH_PAGE_SIZE at a time
+SEARCH_TOP = int(st.secrets.get("SEARCH_TOP", 100))
+SEARCH_PAGE_SIZE = int(st.secrets.get("SEARCH_PAGE_SIZE", 20))